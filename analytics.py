@@ -0,0 +1,262 @@
+"""
+Analytical queries over the star schema, shared by the Flask API and the
+Streamlit dashboard.
+
+Aggregations are pushed down into SQL (GROUP BY period and dimension) so
+callers only ever receive a pivot-sized result. Whenever the grouping
+allows it they read the daily rollup instead of the fact table.
+daily_truck_totals reads the per-day, per-truck sums from that rollup;
+PivotCube turns them into dense arrays the dashboard slices for each pivot.
+"""
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Date, cast, func, select
+
+from models import DimDate, DimEquipment, DimSite, DimFacilitator, FactOperations, AggDailyOperations, EtlWatermark
+from olap import WATERMARK_NAME, date_key
+
+GRAINS = ('week', 'month', 'quarter', 'year')
+METRICS = ('trips_covered', 'fuel_amount', 'hours_lost_breakdown', 'hours_lost_rain', 'number_of_trucks')
+GROUP_BY = ('truck_id', 'truck_type', 'equipment_make', 'site_location', 'facilitator_name')
+
+# Dtype plan for frames built from facts_query: categoricals for dimension
+# labels, native numeric types for measures (not Decimal objects), and
+# datetime64 dates, so pivots and sums run vectorised.
+FACT_DTYPES = {
+    'number_of_trucks': 'Int64',
+    'trips_covered': 'Int64',
+    'fuel_amount': 'float64',
+    'hours_lost_breakdown': 'float64',
+    'hours_lost_rain': 'float64',
+    'year': 'int16',
+    'quarter': 'int8',
+    'week_of_year': 'int8',
+    'month_name': 'category',
+    'truck_type': 'category',
+    'equipment_make': 'category',
+    'facilitator_name': 'category',
+    'site_location': 'category',
+}
+
+
+def _group_expression(group_by):
+    if group_by == 'truck_id':
+        # Aligns trucks with the same make and type, e.g. 'Volvo - truck'.
+        return DimEquipment.equipment_make + ' - ' + DimEquipment.truck_type
+    if group_by in ('truck_type', 'equipment_make'):
+        return getattr(DimEquipment, group_by)
+    if group_by == 'site_location':
+        return DimSite.site_location
+    return DimFacilitator.facilitator_name
+
+
+def aggregate_query(start, end, grain, metric, group_by='truck_id'):
+    """
+    Statement summing `metric` per `grain` period and `group_by` member between
+    `start` and `end` inclusive. Rows are (period, group, value), where period
+    is the first day of the period. Raises ValueError for unknown arguments.
+    """
+    if grain not in GRAINS:
+        raise ValueError(f"Invalid grain. Use one of: {', '.join(GRAINS)}.")
+    if metric not in METRICS:
+        raise ValueError(f"Invalid metric. Use one of: {', '.join(METRICS)}.")
+    if group_by not in GROUP_BY:
+        raise ValueError(f"Invalid group_by. Use one of: {', '.join(GROUP_BY)}.")
+
+    # The rollup has no facilitator, so only that grouping needs the fact table.
+    source = FactOperations if group_by == 'facilitator_name' else AggDailyOperations
+    period = cast(func.date_trunc(grain, DimDate.full_date), Date).label('period')
+    group = _group_expression(group_by).label('group')
+
+    query = select(period, group, func.sum(getattr(source, metric)).label('value'))\
+        .join(DimDate, DimDate.date_key == source.date_key)\
+        .where(source.date_key.between(date_key(start), date_key(end)))
+    if group_by in ('truck_id', 'truck_type', 'equipment_make'):
+        query = query.join(DimEquipment, DimEquipment.equipment_key == source.equipment_key)
+    elif group_by == 'site_location':
+        query = query.join(DimSite, DimSite.site_key == source.site_key)
+    else:
+        query = query.outerjoin(DimFacilitator, DimFacilitator.facilitator_key == source.facilitator_key)
+    return query.group_by(period, group).order_by(period, group)
+
+
+def aggregate(session, start, end, grain, metric, group_by='truck_id'):
+    """Runs aggregate_query and returns its rows."""
+    return session.execute(aggregate_query(start, end, grain, metric, group_by)).all()
+
+
+def period_label(grain, start):
+    """Display label for the period starting on `start`, e.g. '2024-03' or '2024Q1'."""
+    if grain == 'week':
+        return f"{start}/{start + timedelta(days=6)}"
+    if grain == 'month':
+        return start.strftime('%Y-%m')
+    if grain == 'quarter':
+        return f"{start.year}Q{(start.month - 1) // 3 + 1}"
+    return str(start.year)
+
+
+def date_bounds(session):
+    """First and last day with any facts, or (None, None) when there are none."""
+    low, high = session.execute(
+        select(func.min(AggDailyOperations.date_key), func.max(AggDailyOperations.date_key))
+    ).one()
+    if low is None:
+        return None, None
+    return (date(low // 10000, low // 100 % 100, low % 100), date(high // 10000, high // 100 % 100, high % 100))
+
+
+def facts_query(start, end):
+    """Fact rows joined to all four dimensions for `start`..`end` inclusive."""
+    return select(
+        FactOperations.number_of_trucks,
+        FactOperations.trips_covered,
+        FactOperations.fuel_amount,
+        FactOperations.hours_lost_breakdown,
+        FactOperations.hours_lost_rain,
+        DimDate.full_date,
+        DimDate.year,
+        DimDate.quarter,
+        DimDate.month_name,
+        DimDate.week_of_year,
+        DimEquipment.truck_type,
+        DimEquipment.equipment_make,
+        DimFacilitator.facilitator_name,
+        DimSite.site_location
+    ).join(DimDate, FactOperations.date_key == DimDate.date_key)\
+     .join(DimEquipment, FactOperations.equipment_key == DimEquipment.equipment_key)\
+     .join(DimSite, FactOperations.site_key == DimSite.site_key)\
+     .outerjoin(DimFacilitator, FactOperations.facilitator_key == DimFacilitator.facilitator_key)\
+     .where(FactOperations.date_key.between(date_key(start), date_key(end)))
+
+
+def truck_ids(equipment_make, truck_type):
+    """
+    Categorical 'make - type' truck IDs built from the codes of two categorical
+    columns, so only one label per distinct pair present is ever formatted.
+    Distinct pairs can share a label (make 'A - B' with type 'C', make 'A'
+    with type 'B - C'); they get the same ID, as in the SQL aggregates.
+    """
+    makes, types = equipment_make.cat, truck_type.cat
+    make_codes, type_codes, width = makes.codes.to_numpy(), types.codes.to_numpy(), len(types.categories)
+    missing = (make_codes < 0) | (type_codes < 0)
+    pairs = make_codes.astype('int64') * width + type_codes
+    present, pair_index = np.unique(pairs[~missing], return_inverse=True)
+    labels = pd.Index([f"{makes.categories[pair // width]} - {types.categories[pair % width]}" for pair in present])
+    categories = labels.unique()
+    codes = np.full(len(pairs), -1, dtype='int64')
+    codes[~missing] = categories.get_indexer(labels)[pair_index]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=equipment_make.index)
+
+
+def compact_facts(df):
+    """Applies FACT_DTYPES to a facts_query frame and adds its truck_id column."""
+    df = df.astype({column: dtype for column, dtype in FACT_DTYPES.items() if column in df})
+    df['full_date'] = pd.to_datetime(df['full_date'])
+    # Create a unique Truck ID for grouping, aligning trucks with the same make and type
+    df['truck_id'] = truck_ids(df['equipment_make'], df['truck_type'])
+    return df
+
+
+DAILY_TOTALS_METRICS = ('trips_covered', 'fuel_amount', 'hours_lost_breakdown', 'hours_lost_rain', 'number_of_trucks')
+
+
+def daily_truck_totals_query():
+    """The daily rollup summed per day and truck_id, over every site."""
+    truck_id = _group_expression('truck_id').label('truck_id')
+    return select(
+        DimDate.full_date,
+        truck_id,
+        *(func.sum(getattr(AggDailyOperations, m)).label(m) for m in DAILY_TOTALS_METRICS)
+    ).join(DimDate, DimDate.date_key == AggDailyOperations.date_key)\
+     .join(DimEquipment, DimEquipment.equipment_key == AggDailyOperations.equipment_key)\
+     .group_by(DimDate.full_date, truck_id)\
+     .order_by(DimDate.full_date, truck_id)
+
+
+def daily_truck_totals(session):
+    """
+    Per-day, per-truck_id sums of the dashboard metrics. They come from
+    AggDailyOperations, which the OLAP loader keeps up to date as it loads
+    facts, so the result is only as large as days x truck IDs.
+
+    Callers re-read it in full after each load (see loaded_at) rather than
+    splicing in the changed days: a load can touch any past day, and the
+    rollup is small next to the fact table, so one grouped scan of it per
+    load stays cheap while history grows by a row per truck ID per day.
+    """
+    frame = pd.DataFrame(session.execute(daily_truck_totals_query()).all(),
+                         columns=['full_date', 'truck_id', *DAILY_TOTALS_METRICS])
+    return frame.astype({'truck_id': 'category', **{m: 'float64' for m in DAILY_TOTALS_METRICS}})\
+        .assign(full_date=pd.to_datetime(frame['full_date']))
+
+
+def loaded_at(session):
+    """
+    When the OLAP loader last advanced its watermark (or rebuild_rollups last
+    touched it), or None before the first load. Keys caches of anything read
+    from the star schema.
+    """
+    return session.execute(select(EtlWatermark.updated_at).where(EtlWatermark.name == WATERMARK_NAME)).scalar()
+
+
+# pandas period frequency for each grain; weeks run Monday to Sunday like date_trunc('week').
+PERIOD_FREQ = {'week': 'W-SUN', 'month': 'M', 'quarter': 'Q', 'year': 'Y'}
+
+
+
+class PivotCube:
+    """
+    daily_truck_totals as a dense metric x day x truck_id array, with every
+    calendar day between the first and last one present.
+
+    Each grain maps every day to its period once, at build time. A pivot is
+    then a slice of the selected days for one metric, summed over runs of
+    days in the same period with np.add.reduceat, never a groupby.
+    """
+
+    def __init__(self, frame, metrics=DAILY_TOTALS_METRICS):
+        self.metrics = tuple(metrics)
+        trucks = frame['truck_id'].astype('category').cat.remove_unused_categories()
+        self.trucks = pd.Index(trucks.cat.categories.astype(str), name='truck_id')
+        if frame.empty:
+            self.days = pd.DatetimeIndex([])
+        else:
+            self.days = pd.date_range(frame['full_date'].min(), frame['full_date'].max(), freq='D')
+
+        day = ((frame['full_date'] - self.days[0]) // pd.Timedelta(days=1)).to_numpy() if len(self.days) else []
+        truck = trucks.cat.codes.to_numpy()
+        self.values = np.zeros((len(self.metrics), len(self.days), len(self.trucks)))
+        # Null sums count as 0, as in the pivot's fillna(0); `present` still tells empty cells apart.
+        self.values[:, day, truck] = frame[list(self.metrics)].to_numpy(dtype='float64', na_value=0.0).T
+        self.present = np.zeros((len(self.days), len(self.trucks)), dtype=bool)
+        self.present[day, truck] = True
+
+        self.periods = {grain: self.days.to_period(freq).start_time for grain, freq in PERIOD_FREQ.items()}
+
+    @property
+    def first_day(self):
+        return self.days[0].date() if len(self.days) else None
+
+    @property
+    def last_day(self):
+        return self.days[-1].date() if len(self.days) else None
+
+    def pivot(self, start, end, grain, metric):
+        """`metric` per `grain` period (rows, labelled) and truck_id (columns) for `start`..`end` inclusive."""
+        low = self.days.searchsorted(pd.Timestamp(start))
+        high = self.days.searchsorted(pd.Timestamp(end), side='right')
+        if low >= high:
+            return pd.DataFrame(columns=self.trucks[:0])
+
+        # Days are consecutive, so each period is one run of rows; reduceat sums every run.
+        periods = self.periods[grain][low:high]
+        runs = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+        sums = np.add.reduceat(self.values[self.metrics.index(metric), low:high], runs, axis=0)
+        seen = np.logical_or.reduceat(self.present[low:high], runs, axis=0)
+
+        rows, columns = seen.any(axis=1), seen.any(axis=0)
+        labels = [period_label(grain, period.date()) for period in periods[runs][rows]]
+        return pd.DataFrame(sums[np.ix_(rows, columns)], index=labels, columns=self.trucks[columns])
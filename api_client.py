@@ -0,0 +1,167 @@
+"""
+Client for the Flask /api/v1 endpoints, shared by the Streamlit app and the
+Cloud Function ETL.
+
+All calls go through one requests.Session, so connections to the API are
+kept alive and reused instead of paying a new TCP and TLS handshake each
+time. Every call has a (connect, read) timeout. Reads are retried with
+exponential backoff on connection errors and on 429/502/503/504. Writes are
+retried only when they carry an Idempotency-Key, which makes a repeat safe.
+Responses may be gzip-compressed, and bulk uploads are sent gzipped.
+"""
+import gzip
+import io
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed by export_table.
+    pa = pq = None
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 60
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 502, 503, 504)
+# A keyed write that gets 409 is still running under its first attempt; waiting and retrying gets its replay.
+WRITE_RETRY_STATUSES = (409,) + RETRY_STATUSES
+POOL_SIZE = 10
+
+
+class APIClient:
+    """Keep-alive session for the logistics API. Safe to share between threads."""
+
+    def __init__(self, base_url, api_key, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES,
+                 backoff_factor=BACKOFF_FACTOR, pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+
+        self.session = requests.Session()
+        self.session.headers.update({'X-API-Key': api_key, 'Accept-Encoding': 'gzip, deflate'})
+        # The adapter retries idempotent methods only; keyed POSTs are retried by _write.
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=Retry(
+            total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUSES,
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, raise_on_status=False, respect_retry_after_header=True,
+        ))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _url(self, path):
+        return f"{self.base_url}/api/v1/{path}"
+
+    def get(self, path, **params):
+        """GETs /api/v1/<path>. Returns the Response whatever its status."""
+        return self.session.get(self._url(path), params=params, timeout=self.timeout)
+
+    def _write(self, path, idempotency_key=None, **kwargs):
+        """
+        POSTs to /api/v1/<path>. With an idempotency key, connection errors,
+        timeouts and retryable statuses are retried with the same key and body.
+        """
+        headers = kwargs.pop('headers', {})
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        attempts = self.retries + 1 if idempotency_key else 1
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                response = self.session.post(self._url(path), headers=headers, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+            else:
+                if last or response.status_code not in WRITE_RETRY_STATUSES:
+                    return response
+            time.sleep(self.backoff_factor * 2 ** attempt)
+
+    def create_operation(self, payload, idempotency_key=None):
+        """Creates one operation. Returns the API's JSON response; raises HTTPError on failure."""
+        response = self._write('operations', idempotency_key or str(uuid.uuid4()), json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    def create_operations_bulk(self, rows, idempotency_key=None, compress=True):
+        """
+        Uploads rows (dicts) as NDJSON to the bulk endpoint. Returns the response
+        JSON and status code, since a 207 or 422 carries per-row errors.
+        """
+        body = '\n'.join(json.dumps(row, default=str) for row in rows).encode('utf-8')
+        headers = {'Content-Type': 'application/x-ndjson'}
+        if compress:
+            # mtime=0 keeps the bytes identical across calls, so the idempotency fingerprint matches.
+            body = gzip.compress(body, mtime=0)
+            headers['Content-Encoding'] = 'gzip'
+        response = self._write('operations/bulk', idempotency_key or str(uuid.uuid4()), data=body, headers=headers)
+        if response.status_code not in (201, 207, 422):
+            response.raise_for_status()
+        return response.json(), response.status_code
+
+    def export_bytes(self, start_date=None, end_date=None, period=None, fmt='parquet'):
+        """
+        Raw export for a period ('weekly', 'monthly', 'quarterly') or an
+        inclusive date range. Returns None when there is no data.
+        """
+        params = {'format': fmt}
+        if period:
+            params['period'] = period
+        else:
+            params.update(start_date=start_date.isoformat(), end_date=end_date.isoformat())
+        response = self.get('export', **params)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.content
+
+    def export_table(self, start_date=None, end_date=None, period=None, parts=1):
+        """
+        Export as a pyarrow Table, or None when there is no data. A date range
+        can be split into `parts` consecutive sub-ranges fetched in parallel;
+        they are stitched back together in date order.
+        """
+        if pa is None:
+            raise RuntimeError("export_table needs pyarrow installed.")
+        if period or parts <= 1:
+            payloads = [self.export_bytes(start_date, end_date, period)]
+        else:
+            ranges = split_range(start_date, end_date, parts)
+            with ThreadPoolExecutor(max_workers=min(len(ranges), self.pool_size)) as executor:
+                payloads = list(executor.map(lambda r: self.export_bytes(*r), ranges))
+
+        tables = [pq.read_table(io.BytesIO(payload)) for payload in payloads if payload]
+        if not tables:
+            return None
+        return pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+
+
+def split_range(start_date, end_date, parts):
+    """Splits start_date..end_date (inclusive) into at most `parts` consecutive, non-overlapping ranges."""
+    days = (end_date - start_date).days + 1
+    parts = max(1, min(parts, days))
+    size, extra = divmod(days, parts)
+    ranges, start = [], start_date
+    for index in range(parts):
+        end = start + timedelta(days=size + (index < extra) - 1)
+        ranges.append((start, end))
+        start = end + timedelta(days=1)
+    return ranges
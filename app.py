@@ -1,13 +1,27 @@
-import io
+from contextlib import nullcontext
 from datetime import date, datetime, timedelta
 
 from functools import wraps
-import pandas as pd
-from dateutil.relativedelta import relativedelta
-from flask import Flask, Response, jsonify, request, render_template, flash, redirect, url_for
-from models import db, DailyOperation, DimDate, DimEquipment, DimSite, DimFacilitator, FactOperations
+import click
+from flask import Flask, Response, jsonify, request, render_template, flash, redirect, url_for, stream_with_context
+from models import db, DailyOperation
 from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import RequestEntityTooLarge
 from forms import DailyEntryForm
+from export import (FORMATS as EXPORT_FORMATS, pa, negotiate_format, iter_chunks, operations_between, peek,
+                    csv_stream, parquet_stream, arrow_stream)
+import analytics
+import changes
+import listing
+from cache import Cache
+from metrics import Metrics
+from profiling import LoadStats, Profiler
+import migrations
+import queries
+import idempotency
+from idempotency import idempotent, purge_expired
+from ingest import PayloadError, PayloadTooLarge, decode_body, insert_batches, read_rows, upload_content_type, validate_rows
+from olap import BATCH_SIZE, populate_olap, rebuild_rollups, seed_dim_date
 
 app = Flask(__name__)
 
@@ -30,77 +44,122 @@ def require_api_key(f):
 app.config.from_object('config.Config')
 db.init_app(app)
 
+# Server-side cache for page data; see cache.py.
+cache = Cache.from_config(app.config)
+TRACKER_CACHE = 'tracker'
+
+# Request, SQL, cache and pool metrics for GET /metrics; see metrics.py.
+metrics = Metrics()
+metrics.init_app(app)
+metrics.add_collected('cache_hits_total', 'Page cache lookups that found an entry.', lambda: cache.hits, 'counter')
+metrics.add_collected('cache_misses_total', 'Page cache lookups that found nothing.', lambda: cache.misses, 'counter')
+metrics.add_collected('cache_invalidations_total', 'Page cache namespace invalidations.', lambda: cache.invalidations, 'counter')
+metrics.add_collected('db_pool_checked_out', 'Database connections in use.', lambda: _pool_stat('checkedout'))
+metrics.add_collected('db_pool_size', 'Configured size of the database connection pool.', lambda: _pool_stat('size'))
+
+def _pool_stat(name):
+    """A QueuePool statistic such as size(); None (no sample) for pools without it, e.g. NullPool or StaticPool."""
+    stat = getattr(db.engine.pool, name, None)
+    return stat() if stat is not None else None
+
 @app.cli.command('init-db')
 def init_db_command():
     """Creates the database tables."""
     with app.app_context():
         db.create_all()
+        # The tables now match the models, so every migration counts as applied.
+        migrations.stamp()
     print('Initialized the database.')
 
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Applies pending schema migrations."""
+    try:
+        applied = migrations.upgrade()
+    except SQLAlchemyError as e:
+        print(f"An error occurred: {e}")
+        return
+    for version, description in applied:
+        print(f"Applied migration {version}: {description}")
+    print("Database schema is up to date.")
+
+@app.cli.command('db-status')
+def db_status_command():
+    """Lists schema migrations that have not been applied yet."""
+    pending = migrations.pending()
+    for version, description in pending:
+        print(f"Pending migration {version}: {description}")
+    if not pending:
+        print("Database schema is up to date.")
+
+@app.cli.command('check-queries')
+@click.option('--min-rows', default=queries.SEQ_SCAN_MIN_ROWS, show_default=True,
+              help='Only flag sequential scans on tables at least this large.')
+def check_queries_command(min_rows):
+    """Runs EXPLAIN on the app's known queries and flags sequential scans on large tables."""
+    with db.engine.connect() as connection:
+        results = queries.check_queries(connection, min_rows=min_rows)
+    for name, plan, warnings in results:
+        status = "WARN" if warnings else "ok"
+        print(f"[{status}] {name}: {plan['Node Type']} (cost {plan['Total Cost']:,.0f})")
+        for warning in warnings:
+            print(f"    {warning}")
+    if any(warnings for _, _, warnings in results):
+        raise SystemExit(1)
+
 @app.cli.command('populate-olap')
-def populate_olap_command():
+@click.option('--full', is_flag=True, help='Rescan all operations instead of starting at the watermark.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Operations resolved and inserted per batch.')
+@click.option('--profile', is_flag=True, help='Profile the run and write a report with per-phase SQL counts.')
+@click.option('--profile-dir', default='.', show_default=True, help='Directory for the --profile report.')
+def populate_olap_command(full, batch_size, profile, profile_dir):
     """Populates the OLAP dimension and fact tables from the daily operations."""
     print("Starting OLAP data population...")
-    
-    # A more robust solution would track processed IDs, but for this example, we'll check existence.
-    operations = DailyOperation.query.all()
-    
-    with db.session.no_autoflush:
-        for op in operations:
-            # Check if a fact record for this operation already exists
-            fact_exists = FactOperations.query.filter_by(source_operation_id=op.id).first()
-            if fact_exists:
-                continue
-
-            # 1. Get or Create Date Dimension
-            date_dim = DimDate.query.filter_by(full_date=op.operation_date).first()
-            if not date_dim:
-                dt = op.operation_date
-                date_dim = DimDate(
-                    date_key=int(dt.strftime('%Y%m%d')),
-                    full_date=dt, year=dt.year, quarter=(dt.month - 1) // 3 + 1,
-                    month=dt.month, month_name=dt.strftime('%B'), day=dt.day,
-                    day_of_week=dt.strftime('%A'), week_of_year=dt.isocalendar()[1]
-                )
-                db.session.add(date_dim)
-                db.session.flush()
-
-            # 2. Get or Create Equipment Dimension
-            equip_dim = DimEquipment.query.filter_by(truck_type=op.truck_type, equipment_make=op.equipment_make).first()
-            if not equip_dim:
-                equip_dim = DimEquipment(truck_type=op.truck_type, equipment_make=op.equipment_make)
-                db.session.add(equip_dim)
-                db.session.flush()
-
-            # 3. Get or Create Site Dimension
-            site_dim = DimSite.query.filter_by(site_location=op.site_location).first()
-            if not site_dim:
-                site_dim = DimSite(site_location=op.site_location)
-                db.session.add(site_dim)
-                db.session.flush()
-
-            # 4. Get or Create Facilitator Dimension
-            facilitator_dim = None
-            if op.facilitator_name:
-                facilitator_dim = DimFacilitator.query.filter_by(facilitator_name=op.facilitator_name).first()
-                if not facilitator_dim:
-                    facilitator_dim = DimFacilitator(facilitator_name=op.facilitator_name)
-                    db.session.add(facilitator_dim)
-                    db.session.flush()
-
-            # 5. Create Fact Record
-            fact = FactOperations(
-                date_key=date_dim.date_key, equipment_key=equip_dim.equipment_key,
-                site_key=site_dim.site_key, facilitator_key=facilitator_dim.facilitator_key if facilitator_dim else None,
-                number_of_trucks=op.number_of_trucks, trips_covered=op.trips_covered, fuel_amount=op.fuel_amount,
-                hours_lost_breakdown=op.hours_lost, hours_lost_rain=op.rain_hours_lost,
-                total_lease_rate=op.total_lease_rate, daily_commission=op.daily_commission_rate,
-                source_operation_id=op.id
-            )
-            db.session.add(fact)
+    stats = LoadStats()
+    profiler = Profiler('populate-olap', stats, profile_dir) if profile else None
     try:
-        db.session.commit()
+        with profiler or nullcontext():
+            populate_olap(full=full, batch_size=batch_size, stats=stats)
+        # Only reaches web workers when they share a cache backend (CACHE_REDIS_URL); otherwise the TTL applies.
+        cache.invalidate(TRACKER_CACHE)
         print("OLAP tables populated successfully.")
+        print(stats.report())
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"An error occurred: {e}")
+    if profiler:
+        print(f"Profile written to {profiler.report_path}")
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recomputes the daily rollup table from the fact table."""
+    try:
+        rebuild_rollups(db.session)
+        db.session.commit()
+        cache.invalidate(TRACKER_CACHE)
+        print("Daily rollups rebuilt.")
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"An error occurred: {e}")
+
+@app.cli.command('seed-dim-date')
+@click.option('--from', 'start', type=click.DateTime(formats=['%Y-%m-%d']), required=True, help='First day (YYYY-MM-DD).')
+@click.option('--to', 'end', type=click.DateTime(formats=['%Y-%m-%d']), required=True, help='Last day (YYYY-MM-DD).')
+def seed_dim_date_command(start, end):
+    """Pre-generates the DimDate calendar for a date range."""
+    try:
+        inserted = seed_dim_date(db.session, start.date(), end.date())
+        db.session.commit()
+        print(f"Seeded {inserted} new calendar days from {start.date()} to {end.date()}.")
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"An error occurred: {e}")
+
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Deletes expired idempotency keys."""
+    try:
+        print(f"Purged {purge_expired()} expired idempotency keys.")
     except SQLAlchemyError as e:
         db.session.rollback()
         print(f"An error occurred: {e}")
@@ -153,6 +212,7 @@ def entry():
             )
             db.session.add(new_entry)
             db.session.commit()
+            cache.invalidate(TRACKER_CACHE)
             flash('Daily entry saved successfully!', 'success')
             return redirect(url_for('entry'))
         except SQLAlchemyError as e:
@@ -164,36 +224,32 @@ def entry():
 @app.route('/tracker')
 def tracker():
     """Serves the contract tracker page."""
-    from sqlalchemy import func
+    today = date.today()
+    # The data only changes when an entry is saved or the OLAP loader runs, both of which invalidate it.
+    data = cache.get_or_set(TRACKER_CACHE, today.isoformat(), lambda: _tracker_data(today))
+    return render_template('tracker.html', today=today, **data)
 
-    # --- Example 1: Original view of contracts (distinct facilitators) ---
-    # This still queries the OLTP table for operational data.
-    contracts = db.session.query(DailyOperation).distinct(DailyOperation.facilitator_name).order_by(DailyOperation.facilitator_name, DailyOperation.operation_date.desc()).all()
+def _tracker_data(today):
+    """Queries everything the tracker page shows."""
+    # --- Example 1: Contracts, one row per facilitator for their latest lease ---
+    # Read from the contract ledger, which every write to daily_operation keeps current.
+    contracts = db.session.execute(queries.contracts(today)).mappings().all()
 
     # --- Example 2: New OLAP-style query ---
     # Get total trips and fuel usage per equipment type for the last 90 days.
-    ninety_days_ago = date.today() - timedelta(days=90)
-    start_date_key = int(ninety_days_ago.strftime('%Y%m%d'))
-
-    analytics_data = db.session.query(
-        DimEquipment.truck_type,
-        DimEquipment.equipment_make,
-        func.sum(FactOperations.trips_covered).label('total_trips'),
-        func.sum(FactOperations.fuel_amount).label('total_fuel')
-    ).join(FactOperations, DimEquipment.equipment_key == FactOperations.equipment_key)\
-     .join(DimDate, FactOperations.date_key == DimDate.date_key)\
-     .filter(DimDate.date_key >= start_date_key)\
-     .group_by(DimEquipment.truck_type, DimEquipment.equipment_make)\
-     .order_by(DimEquipment.truck_type, func.sum(FactOperations.trips_covered).desc())\
-     .all()
-    return render_template('tracker.html', contracts=contracts, today=date.today(), analytics_data=analytics_data)
+    ninety_days_ago = today - timedelta(days=90)
+    analytics_data = db.session.execute(queries.equipment_summary(ninety_days_ago)).mappings().all()
+    # Plain dicts, not ORM instances or Rows, since the result is cached (and pickled into Redis).
+    return {'contracts': [dict(row) for row in contracts], 'analytics_data': [dict(row) for row in analytics_data]}
 
 @app.route('/api/v1/operations', methods=['POST'])
 @require_api_key
+@idempotent
 def create_operation():
     """
     API endpoint to create a new daily operation entry.
-    Expects a JSON payload with the operation data.
+    Expects a JSON payload with the operation data. Send an Idempotency-Key
+    header to make retries safe.
     """
     data = request.get_json()
     if not data:
@@ -212,24 +268,216 @@ def create_operation():
 
         new_entry = DailyOperation(**data)
         db.session.add(new_entry)
-        db.session.commit()
+        idempotency.commit()
+        idempotency.on_commit(lambda: cache.invalidate(TRACKER_CACHE))
         return jsonify({"message": "Operation created successfully", "id": new_entry.id}), 201
     except (SQLAlchemyError, TypeError, ValueError) as e:
         db.session.rollback()
         app.logger.error(f"Error creating operation: {e}")
         return jsonify({"error": "Failed to create operation.", "details": str(e)}), 500
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    """Bodies over MAX_CONTENT_LENGTH (e.g. a bulk upload) are refused while being read."""
+    return jsonify({"error": f"Request body is larger than {app.config['MAX_CONTENT_LENGTH']} bytes."}), 413
+
+@app.route('/api/v1/operations/bulk', methods=['POST'])
+@require_api_key
+@idempotent
+def create_operations_bulk():
+    """
+    API endpoint to create many daily operation entries in one call.
+    Accepts a JSON array, NDJSON, or CSV, either as the request body (which may
+    be sent with Content-Encoding: gzip) or as a 'file' upload. Valid rows are
+    inserted in batches of one transaction each; invalid rows are reported by
+    their 0-based position and don't stop the rest.
+    """
+    upload = request.files.get('file')
+    if upload:
+        body, content_type = upload.read(), upload_content_type(upload.filename, upload.mimetype)
+    else:
+        body, content_type = request.get_data(), request.mimetype
+
+    try:
+        if not upload:
+            body = decode_body(body, request.content_encoding, app.config['BULK_INGEST_MAX_BYTES'])
+        raw_rows = read_rows(body, content_type)
+    except PayloadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except UnicodeDecodeError:
+        return jsonify({"error": "Payload must be UTF-8 encoded."}), 400
+
+    max_rows = app.config['BULK_INGEST_MAX_ROWS']
+    if len(raw_rows) > max_rows:
+        return jsonify({"error": f"Too many rows. Send at most {max_rows} per request."}), 413
+
+    valid, errors = validate_rows(raw_rows)
+    inserted, failed = insert_batches(db.session, valid, commit=idempotency.commit)
+    if inserted:
+        idempotency.on_commit(lambda: cache.invalidate(TRACKER_CACHE))
+    errors = sorted(errors + failed, key=lambda error: error[0])
+    if errors:
+        app.logger.warning(f"Bulk operation upload rejected {len(errors)} of {len(raw_rows)} rows")
+
+    status = 201 if not errors else 207 if inserted else 422
+    return jsonify({
+        "received": len(raw_rows),
+        "inserted": inserted,
+        "failed": len(errors),
+        "errors": [{"row": index, "errors": row_errors} for index, row_errors in errors],
+    }), status
+
+@app.route('/api/v1/cache/stats', methods=['GET'])
+@require_api_key
+def cache_stats():
+    """API endpoint reporting hit-rate metrics for this worker's cache."""
+    return jsonify(cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+@require_api_key
+def metrics_endpoint():
+    """Prometheus scrape endpoint for this worker's request, SQL, cache and pool metrics."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/v1/changes', methods=['GET'])
+@require_api_key
+def list_changes():
+    """
+    API endpoint serving the daily_operation change feed, oldest first.
+    Query Parameters:
+    - since: cursor from a previous response's 'next_cursor' (omit to start from the beginning)
+    - limit: page size (default 1000, at most 10000)
+    Keep calling with the returned 'next_cursor' while 'has_more' is true; once
+    it is false, poll again later with the same cursor.
+    """
+    try:
+        limit = int(request.args.get('limit', changes.PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Invalid limit. Use a whole number."}), 400
+    if not 1 <= limit <= changes.MAX_PAGE_SIZE:
+        return jsonify({"error": f"Invalid limit. Use 1 to {changes.MAX_PAGE_SIZE}."}), 400
+
+    try:
+        page, next_cursor, has_more = changes.read_changes(db.session, request.args.get('since'), limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error while reading changes: {e}")
+        return jsonify({"error": "A database error occurred."}), 500
+
+    return jsonify({
+        "changes": [
+            {"id": change.id, "operation_id": change.operation_id, "action": change.action,
+             "operation_date": change.operation_date.isoformat(), "changed_at": change.changed_at.isoformat()}
+            for change in page
+        ],
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+    })
+
+@app.route('/api/v1/operations', methods=['GET'])
+@require_api_key
+def list_operations():
+    """
+    API endpoint paging through daily operations by (operation_date, id).
+    Query Parameters:
+    - start_date, end_date: 'YYYY-MM-DD' (optional, inclusive)
+    - site_location, truck_type, facilitator_name: exact-match filters (optional)
+    - fields: comma-separated columns to return (default all; 'id' is always included)
+    - order: 'asc' (default, oldest first) or 'desc'
+    - cursor: 'next_cursor' from the previous page, with the same filters and order
+    - limit: page size (default 100, at most 1000)
+    """
+    try:
+        limit = int(request.args.get('limit', listing.PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Invalid limit. Use a whole number."}), 400
+    if not 1 <= limit <= listing.MAX_PAGE_SIZE:
+        return jsonify({"error": f"Invalid limit. Use 1 to {listing.MAX_PAGE_SIZE}."}), 400
+
+    try:
+        start_date, end_date = (
+            datetime.strptime(request.args[name], '%Y-%m-%d').date() if request.args.get(name) else None
+            for name in ('start_date', 'end_date')
+        )
+    except ValueError:
+        return jsonify({"error": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
+    filters = {name: request.args[name] for name in listing.FILTERS if request.args.get(name)}
+
+    try:
+        fields = listing.parse_fields(request.args.get('fields'))
+        rows, next_cursor, has_more = listing.read_page(
+            db.session, fields, filters, start_date, end_date,
+            request.args.get('cursor'), request.args.get('order', 'asc'), limit
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error while listing operations: {e}")
+        return jsonify({"error": "A database error occurred."}), 500
+
+    return jsonify({"operations": rows, "next_cursor": next_cursor, "has_more": has_more})
+
+@app.route('/api/v1/analytics/aggregate', methods=['GET'])
+@require_api_key
+def aggregate_operations():
+    """
+    API endpoint returning a metric summed per period and dimension member.
+    Query Parameters:
+    - start_date, end_date: 'YYYY-MM-DD' (required)
+    - grain: 'week', 'month', 'quarter' or 'year' (default 'month')
+    - metric: a FactOperations measure, e.g. 'trips_covered' (default)
+    - group_by: 'truck_id' (default), 'truck_type', 'equipment_make', 'site_location' or 'facilitator_name'
+    """
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date()
+    except KeyError:
+        return jsonify({"error": "Please provide both 'start_date' and 'end_date'."}), 400
+    except ValueError:
+        return jsonify({"error": "Invalid date format. Use YYYY-MM-DD."}), 400
+
+    grain = request.args.get('grain', 'month')
+    metric = request.args.get('metric', 'trips_covered')
+    group_by = request.args.get('group_by', 'truck_id')
+    try:
+        rows = analytics.aggregate(db.session, start_date, end_date, grain, metric, group_by)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except SQLAlchemyError as e:
+        app.logger.error(f"Database error during aggregation: {e}")
+        return jsonify({"error": "A database error occurred."}), 500
+
+    return jsonify({
+        "grain": grain,
+        "metric": metric,
+        "group_by": group_by,
+        "rows": [
+            {"period": row.period.isoformat(), "label": analytics.period_label(grain, row.period),
+             "group": row.group, "value": float(row.value) if row.value is not None else None}
+            for row in rows
+        ],
+    })
+
 @app.route('/api/v1/export', methods=['GET'])
 @require_api_key
 def export_data():
     """
-    API endpoint to export data as CSV.
+    API endpoint to export data as CSV, Parquet or Arrow, streamed in chunks.
     Query Parameters:
     - period: 'weekly', 'monthly', 'quarterly'
     - start_date: 'YYYY-MM-DD' (used with end_date)
     - end_date: 'YYYY-MM-DD' (used with start_date)
+    - format: 'csv', 'parquet' or 'arrow' (defaults to the Accept header, then CSV)
     """
     today = date.today()
+    export_format = negotiate_format(request.args.get('format'), request.accept_mimetypes)
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": "Invalid format. Use 'csv', 'parquet', or 'arrow'."}), 400
+    if export_format != 'csv' and pa is None:
+        return jsonify({"error": f"The '{export_format}' format is not available on this server."}), 406
     period = request.args.get('period')
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
@@ -257,33 +505,42 @@ def export_data():
     else:
         return jsonify({"error": "Please provide a 'period' or both 'start_date' and 'end_date'."}), 400
 
+    statement = operations_between(start_date, end_date)
+    # The server-side cursor needs a connection of its own: db.session is closed
+    # when the view returns, which would invalidate the cursor mid-stream.
+    connection = db.engine.connect()
     try:
-        query = DailyOperation.query.filter(
-            DailyOperation.operation_date.between(start_date, end_date)
-        )
-        
-        # Use pandas to read directly from the SQLAlchemy query
-        df = pd.read_sql(query.statement, db.session.bind)
-
-        if df.empty:
-            return jsonify({"message": "No data found for the selected period."}), 404
-
-        # Create an in-memory text buffer
-        buffer = io.StringIO()
-        df.to_csv(buffer, index=False)
-        
-        # Seek to the start of the buffer
-        buffer.seek(0)
-
-        return Response(
-            buffer,
-            mimetype="text/csv",
-            headers={"Content-Disposition": f"attachment;filename=logistics_data_{start_date}_to_{end_date}.csv"}
-        )
-
+        # Fetch the first chunk up front so an empty period still gets a 404.
+        chunks = peek(iter_chunks(connection, statement))
     except SQLAlchemyError as e:
+        connection.close()
         app.logger.error(f"Database error during export: {e}")
         return jsonify({"error": "A database error occurred."}), 500
 
+    if chunks is None:
+        connection.close()
+        return jsonify({"message": "No data found for the selected period."}), 404
+
+    encoders = {
+        'csv': lambda: csv_stream(statement.selected_columns.keys(), chunks),
+        'parquet': lambda: parquet_stream(chunks),
+        'arrow': lambda: arrow_stream(chunks),
+    }
+
+    def generate():
+        try:
+            yield from encoders[export_format]()
+        except SQLAlchemyError as e:
+            # Headers are already sent, so all we can do is cut the stream short.
+            app.logger.error(f"Database error while streaming export: {e}")
+        finally:
+            connection.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment;filename=logistics_data_{start_date}_to_{end_date}.{export_format}"}
+    )
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
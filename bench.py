@@ -0,0 +1,407 @@
+"""
+Benchmarks for the Flask API and the OLAP loader.
+
+For each dataset size the harness resets a scratch database, seeds it with
+synthetic operations built from the choice lists in forms.py, and then runs
+every scenario in SCENARIOS through Flask's test client (or directly, for
+the loader). Each scenario reports latency percentiles, throughput and the
+peak Python memory of one traced run.
+
+Results are merged into a JSON file keyed by the current git commit, so runs
+on different commits sit side by side and --compare shows the change. The
+default file, bench_results.json in the working directory, is ignored by git:
+
+    python bench.py --database-url postgresql://localhost/logistics_bench --sizes 10000,100000
+    python bench.py --database-url ... --compare <older commit>
+
+The database named by --database-url (or BENCH_DATABASE_URL) is wiped
+before every size. Never point it at real data.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, time as clock, timedelta
+from decimal import Decimal
+
+RESULTS_FILE = 'bench_results.json'
+SIZES = (10000,)
+REQUESTS = 50
+SEED_BATCH = 10000
+DAYS = 730  # Operations are spread over the two years before today.
+
+
+# --- Synthetic data ---
+
+def _choices(field):
+    """Values (not placeholders) of a DailyEntryForm select/radio field."""
+    return [value for value, _ in field.kwargs['choices'] if value]
+
+
+def synthetic_operations(count, seed=0, end_date=None):
+    """Yields `count` DailyOperation column dicts that look like real entries."""
+    from forms import DailyEntryForm, NIGERIAN_STATES
+
+    rng = random.Random(seed)
+    end_date = end_date or date.today()
+    truck_types = _choices(DailyEntryForm.truck_type)
+    makes = _choices(DailyEntryForm.equipment_make)
+    person_types = _choices(DailyEntryForm.person_type)
+    statuses = _choices(DailyEntryForm.lease_payment_status)
+    # A few hundred facilitators, most working a handful of sites, as in the real data.
+    facilitators = [f"Facilitator {n}" for n in range(max(10, count // 200))]
+
+    for _ in range(count):
+        operation_date = end_date - timedelta(days=rng.randrange(DAYS))
+        had_breakdown, had_rain = rng.random() < 0.08, rng.random() < 0.15
+        lease_start = operation_date - timedelta(days=rng.randrange(60))
+        lease_days = rng.choice((30, 60, 90))
+        sign_in = clock(rng.randint(6, 9), rng.choice((0, 15, 30, 45)))
+        yield dict(
+            truck_type=rng.choice(truck_types),
+            number_of_trucks=rng.choices((1, 2, 3, 4, 5), weights=(50, 25, 12, 8, 5))[0],
+            equipment_make=rng.choice(makes),
+            site_location=rng.choice(NIGERIAN_STATES),
+            person_type=rng.choice(person_types),
+            person_name=f"Operator {rng.randrange(5000)}",
+            trips_covered=rng.randint(0, 25),
+            operation_date=operation_date,
+            facilitator_name=rng.choice(facilitators) if rng.random() < 0.9 else None,
+            daily_commission_rate=Decimal(rng.randrange(5000, 50000, 500)),
+            total_lease_rate=Decimal(rng.randrange(100000, 5000000, 10000)),
+            expected_lease_days=lease_days,
+            lease_start_date=lease_start,
+            lease_end_date=lease_start + timedelta(days=lease_days),
+            lease_payment_status=rng.choice(statuses),
+            sign_in=sign_in,
+            sign_out=clock(sign_in.hour + rng.randint(7, 11), sign_in.minute),
+            fuel_amount=Decimal(rng.randrange(2000, 60000)) / 100,
+            minimum_daily_quota=rng.randint(5, 20),
+            had_breakdown=had_breakdown,
+            breakdown_explained='Hydraulic fault' if had_breakdown else None,
+            hours_lost=Decimal(rng.randrange(25, 800, 25)) / 100 if had_breakdown else None,
+            had_rain=had_rain,
+            rain_hours_lost=Decimal(rng.randrange(25, 600, 25)) / 100 if had_rain else None,
+            other_issues_no_rain=None,
+            remarks=None,
+        )
+
+
+def _api_payload(row):
+    """JSON body for POST /api/v1/operations (dates and times as strings, amounts as numbers)."""
+    return {
+        key: (value.isoformat() if isinstance(value, (date, clock)) else
+              float(value) if isinstance(value, Decimal) else value)
+        for key, value in row.items()
+        if key not in ('sign_in', 'sign_out')  # create_operation only converts date fields
+    }
+
+
+def _form_data(row):
+    """Form fields for POST / (the entry page)."""
+    data = {key: '' if value is None else str(value) for key, value in row.items()}
+    data['sign_in'], data['sign_out'] = row['sign_in'].strftime('%H:%M'), row['sign_out'].strftime('%H:%M')
+    data['had_breakdown'] = 'Yes' if row['had_breakdown'] else 'No'
+    data['had_rain'] = 'Yes' if row['had_rain'] else 'No'
+    return data
+
+
+# --- Measurement ---
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def measure(run, repeat):
+    """
+    Calls `run()` `repeat` times and summarises the latencies. Memory is
+    measured on one extra, traced call, so tracing doesn't skew the timings.
+    `run` may return a number of items (rows, bytes) processed, which is
+    reported as items_per_sec.
+    """
+    latencies, items = [], 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        items += run() or 0
+        latencies.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    total = sum(latencies)
+    result = {
+        'count': repeat,
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'p50_ms': round(_percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(_percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'throughput_per_sec': round(repeat / total, 2) if total else None,
+        'peak_mem_mb': round(peak / 2 ** 20, 2),
+    }
+    if items:
+        result['items_per_sec'] = round(items / total, 1)
+    return result
+
+
+# --- Scenarios ---
+
+class Bench:
+    """One benchmark run against the scratch database, for one dataset size."""
+
+    def __init__(self, app, size, requests):
+        from models import db
+
+        self.app, self.db, self.size, self.requests = app, db, size, requests
+        self.client = app.test_client()
+        self.headers = {'X-API-Key': app.config['INTERNAL_API_KEY']}
+        self.rows = synthetic_operations(10 ** 7, seed=size + 1)  # Fresh rows for the write scenarios
+        self.today = date.today()
+
+    def reset(self):
+        """Recreates an empty, fully migrated schema."""
+        import migrations
+
+        self.db.drop_all()
+        self.db.create_all()
+        migrations.stamp()
+
+    def seed(self):
+        """
+        Inserts `size` operations in batches through the ingest path, so the change
+        feed and the contract ledger fill up as they do in production. Returns the
+        seconds it took.
+        """
+        from ingest import insert_batches
+
+        started = time.perf_counter()
+        rows = synthetic_operations(self.size, seed=self.size)
+        while batch := [row for _, row in zip(range(SEED_BATCH), rows)]:
+            insert_batches(self.db.session, list(enumerate(batch)), batch_size=SEED_BATCH)
+        return time.perf_counter() - started
+
+    def _get(self, url):
+        response = self.client.get(url, headers=self.headers)
+        body = response.get_data()  # Drains streamed responses
+        assert response.status_code < 400, (url, response.status_code, body[:200])
+        return len(body)
+
+    def populate_olap_full(self):
+        from olap import populate_olap
+        from sqlalchemy import text
+
+        def run():
+            self.db.session.execute(text(
+                "TRUNCATE fact_operations, agg_daily_operations, etl_watermark RESTART IDENTITY"
+            ))
+            self.db.session.commit()
+            return populate_olap(self.db.session).rows['facts']
+        return measure(run, 1)
+
+    def populate_olap_incremental(self):
+        """Loader run picking up 1% new operations."""
+        from ingest import insert_batches
+        from olap import populate_olap
+
+        new_rows = max(1, self.size // 100)
+
+        def run():
+            insert_batches(self.db.session, list(enumerate(next(self.rows) for _ in range(new_rows))))
+            return populate_olap(self.db.session).rows['facts']
+        return measure(run, 3)
+
+    def entry_post(self):
+        def run():
+            response = self.client.post('/', data=_form_data(next(self.rows)))
+            assert response.status_code == 302, response.status_code  # Redirect after a successful save
+        return measure(run, self.requests)
+
+    def create_operation(self):
+        def run():
+            response = self.client.post('/api/v1/operations', json=_api_payload(next(self.rows)), headers=self.headers)
+            assert response.status_code == 201, response.get_data()
+        return measure(run, self.requests)
+
+    def bulk_upload(self):
+        """POST /api/v1/operations/bulk with 1,000 rows per call."""
+        def run():
+            batch = [_api_payload(next(self.rows)) for _ in range(1000)]
+            response = self.client.post('/api/v1/operations/bulk', json=batch, headers=self.headers)
+            assert response.status_code == 201, response.get_data()[:200]
+            return len(batch)
+        return measure(run, max(3, self.requests // 10))
+
+    def _tracker(self):
+        """
+        GET /tracker, or the view's cached data lookup when the checkout has no
+        tracker.html template to render.
+        """
+        if 'tracker.html' in self.app.jinja_env.list_templates():
+            return self._get('/tracker')
+        from app import TRACKER_CACHE, _tracker_data, cache
+        with self.app.test_request_context('/tracker'):
+            cache.get_or_set(TRACKER_CACHE, self.today.isoformat(), lambda: _tracker_data(self.today))
+
+    def tracker_cold(self):
+        from app import TRACKER_CACHE, cache
+
+        def run():
+            cache.invalidate(TRACKER_CACHE)
+            return self._tracker()
+        return measure(run, self.requests)
+
+    def tracker_warm(self):
+        self._tracker()
+        return measure(self._tracker, self.requests)
+
+    def _export(self, fmt, days):
+        start = (self.today - timedelta(days=days)).isoformat()
+        url = f'/api/v1/export?format={fmt}&start_date={start}&end_date={self.today.isoformat()}'
+        return measure(lambda: self._get(url), max(3, self.requests // 10))
+
+    def export_csv_month(self):
+        return self._export('csv', 30)
+
+    def export_csv_year(self):
+        return self._export('csv', 365)
+
+    def export_parquet_year(self):
+        return self._export('parquet', 365)
+
+    def aggregate(self):
+        start = (self.today - timedelta(days=365)).isoformat()
+        url = f'/api/v1/analytics/aggregate?start_date={start}&end_date={self.today.isoformat()}&grain=month'
+        return measure(lambda: self._get(url), self.requests)
+
+    def changes_page(self):
+        return measure(lambda: self._get('/api/v1/changes?limit=1000'), self.requests)
+
+
+# Run in this order: the loader first, so the read scenarios see populated OLAP tables.
+SCENARIOS = (
+    'populate_olap_full', 'populate_olap_incremental', 'tracker_cold', 'tracker_warm', 'aggregate',
+    'export_csv_month', 'export_csv_year', 'export_parquet_year', 'changes_page',
+    'entry_post', 'create_operation', 'bulk_upload',
+)
+
+
+# --- Results ---
+
+def git_commit():
+    """(commit sha, whether the working tree has uncommitted changes), or ('unknown', True)."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, capture_output=True, text=True,
+                             check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', True
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(path, results):
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def compare(current, baseline):
+    """Lines showing the change in p50/p95 and peak memory from `baseline` to `current`."""
+    lines = []
+    for size, scenarios in current['sizes'].items():
+        for name, now in scenarios.items():
+            then = baseline.get('sizes', {}).get(size, {}).get(name)
+            if not then or 'p50_ms' not in then or 'p50_ms' not in now:
+                continue
+            changes = []
+            for key in ('p50_ms', 'p95_ms', 'peak_mem_mb'):
+                if then[key]:
+                    changes.append(f"{key} {(now[key] - then[key]) / then[key]:+.1%}")
+            lines.append(f"  {size:>9} {name:<28} " + "  ".join(changes))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints and the OLAP loader.")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="Scratch Postgres database; it is wiped. Defaults to BENCH_DATABASE_URL.")
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help="Comma-separated DailyOperation row counts, e.g. 10000,100000,1000000.")
+    parser.add_argument('--requests', type=int, default=REQUESTS, help="Requests per endpoint scenario.")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma-separated subset of scenarios.")
+    parser.add_argument('--output', default=RESULTS_FILE, help="Results file, kept across runs (default: %(default)s).")
+    parser.add_argument('--compare', metavar='COMMIT', help="Print changes relative to this commit's results.")
+    args = parser.parse_args(argv)
+
+    if not args.database_url:
+        parser.error("Pass --database-url (or set BENCH_DATABASE_URL) to a scratch database. It will be wiped.")
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # Config reads DATABASE_URL at import, so point it at the scratch database before importing the app.
+    os.environ['DATABASE_URL'] = args.database_url
+    from app import app
+    app.config.update(WTF_CSRF_ENABLED=False, TESTING=True)
+
+    sha, dirty = git_commit()
+    run = {
+        'commit': sha,
+        'dirty': dirty,
+        'recorded_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'requests': args.requests,
+        'sizes': {},
+    }
+    with app.app_context():
+        for size in (int(s) for s in args.sizes.split(',')):
+            bench = Bench(app, size, args.requests)
+            bench.reset()
+            print(f"Seeding {size:,} operations...", flush=True)
+            results = {'seed': {'seconds': round(bench.seed(), 2)}}
+            for name in scenarios:
+                results[name] = getattr(bench, name)()
+                r = results[name]
+                print(f"  {name:<28} p50 {r['p50_ms']:>10.2f} ms  p95 {r['p95_ms']:>10.2f} ms  "
+                      f"{r['throughput_per_sec'] or 0:>9.1f}/s  peak {r['peak_mem_mb']:>8.2f} MB", flush=True)
+            run['sizes'][str(size)] = results
+
+    results = load_results(args.output)
+    # Runs with uncommitted changes are kept apart, so they never overwrite the commit's own numbers.
+    results[f"{sha}-dirty" if dirty else sha] = run
+    save_results(args.output, results)
+    print(f"Results for {sha[:12]}{' (uncommitted changes)' if dirty else ''} written to {args.output}.")
+
+    if args.compare:
+        baseline = next((r for key, r in results.items() if key.startswith(args.compare)), None)
+        if baseline is None:
+            print(f"No results recorded for {args.compare}.")
+        else:
+            print(f"Compared with {baseline['commit'][:12]}:")
+            print("\n".join(compare(run, baseline)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Server-side cache for computed page data.
+
+Entries live in a backend: a bounded in-process LRU by default, or Redis
+when CACHE_REDIS_URL is set (so several workers and the CLI share entries
+and invalidations). Every entry has a TTL. Entries are grouped in
+namespaces; invalidating a namespace bumps its generation number, which
+orphans every key built with the old one without having to find them.
+
+Without Redis every worker process has its own LRU, and an invalidation
+only reaches the worker that made it: under gunicorn with several workers
+the others keep serving their entries until the TTL expires them.
+Values should be plain data (dicts, lists, numbers); they are pickled into
+Redis, and ORM instances would carry their session state with them.
+"""
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # Only needed for the shared backend.
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class LRUBackend:
+    """Thread-safe, size-bounded in-process store with per-entry expiry."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}  # Generation counters; never expire or get evicted.
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generation(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Shared store in Redis; values are pickled."""
+
+    def __init__(self, url, prefix='logistics:cache:'):
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        data = self._client.get(self._prefix + key)
+        return MISSING if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl):
+        self._client.set(self._prefix + key, pickle.dumps(value), ex=max(int(ttl), 1))
+
+    def generation(self, key):
+        return int(self._client.get(self._prefix + key) or 0)
+
+    def incr(self, key):
+        return self._client.incr(self._prefix + key)
+
+
+class Cache:
+    """TTL cache with namespace invalidation and hit/miss counters (counted per process)."""
+
+    def __init__(self, backend, default_ttl=300):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.hits = self.misses = self.invalidations = 0
+
+    @classmethod
+    def from_config(cls, config):
+        url = config.get('CACHE_REDIS_URL')
+        if url and redis is not None:
+            backend = RedisBackend(url)
+        else:
+            if url:
+                logger.warning("CACHE_REDIS_URL is set but the redis package isn't installed; using the in-process cache.")
+            backend = LRUBackend(config.get('CACHE_MAX_ENTRIES', 256))
+        return cls(backend, config.get('CACHE_DEFAULT_TTL', 300))
+
+    def get_or_set(self, namespace, key, compute, ttl=None):
+        """Returns the cached value for `key`, computing and storing it on a miss."""
+        full_key = f"{namespace}:{self.backend.generation(f'{namespace}:generation')}:{key}"
+        value = self.backend.get(full_key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = compute()
+        self.backend.set(full_key, value, ttl or self.default_ttl)
+        return value
+
+    def invalidate(self, namespace):
+        """Drops every entry in `namespace`. Never raises: a failed invalidation only leaves entries to expire."""
+        try:
+            self.backend.incr(f'{namespace}:generation')
+            self.invalidations += 1
+        except Exception as e:
+            logger.error(f"Cache invalidation for {namespace!r} failed: {e}")
+
+    def stats(self):
+        """
+        Returns this process's counters. `entries` is None for Redis: counting
+        its keys means a SCAN over the whole keyspace, too slow for a stats call.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'entries': len(self.backend) if isinstance(self.backend, LRUBackend) else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,60 @@
+"""
+Change feed over daily_operation, read by GET /api/v1/changes.
+
+Every write to daily_operation appends an OperationChange row in the same
+transaction (models.record_operation_changes). Consumers page through the
+log with an opaque cursor and resume from the last one they processed.
+
+Sequence ids are handed out when rows are written, not when they commit,
+so a plain `id > cursor` read could skip a change whose transaction
+commits late. The feed is therefore ordered by (txid, id) and only
+serves changes from transactions older than every transaction still in
+flight. Anything committed later has a higher txid than all changes
+already served.
+"""
+import base64
+import binascii
+
+from sqlalchemy import func, select, tuple_
+
+from models import OperationChange
+
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+def encode_cursor(txid, change_id):
+    return base64.urlsafe_b64encode(f"{txid}:{change_id}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(txid, id) from a cursor made by encode_cursor. Raises ValueError if it's malformed."""
+    try:
+        txid, change_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split(':')
+        return int(txid), int(change_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor.")
+
+
+def changes_query(after=None, limit=PAGE_SIZE):
+    """Up to `limit` settled changes after the (txid, id) position `after`, oldest first."""
+    settled = func.txid_snapshot_xmin(func.txid_current_snapshot())
+    query = select(OperationChange).where(OperationChange.txid < settled)
+    if after is not None:
+        query = query.where(tuple_(OperationChange.txid, OperationChange.id) > tuple_(*after))
+    return query.order_by(OperationChange.txid, OperationChange.id).limit(limit)
+
+
+def read_changes(session, cursor=None, limit=PAGE_SIZE):
+    """
+    The next page of changes after `cursor` (from the start when None).
+    Returns (changes, next cursor, whether more changes are ready). The
+    next cursor equals `cursor` when nothing new has settled yet.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    changes = session.execute(changes_query(after, limit + 1)).scalars().all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if changes:
+        cursor = encode_cursor(changes[-1].txid, changes[-1].id)
+    return changes, cursor, has_more
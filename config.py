@@ -9,3 +9,27 @@ class Config:
     # A separate, strong key for authenticating internal API requests.
     # Set this in your production environment.
     INTERNAL_API_KEY = os.getenv('INTERNAL_API_KEY', 'a-super-secret-internal-key-change-me')
+    # Upper bound on rows accepted by one call to POST /api/v1/operations/bulk.
+    BULK_INGEST_MAX_ROWS = int(os.getenv('BULK_INGEST_MAX_ROWS', '50000'))
+    # Upper bound on the size of a gzip-encoded bulk body once decompressed.
+    BULK_INGEST_MAX_BYTES = int(os.getenv('BULK_INGEST_MAX_BYTES', str(64 * 1024 * 1024)))
+    # Upper bound on any request body as sent, multipart uploads included; larger requests get a 413.
+    MAX_CONTENT_LENGTH = BULK_INGEST_MAX_BYTES
+    # How long a stored response can be replayed for a retried Idempotency-Key.
+    IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+    # Server-side cache for page data such as /tracker. Set CACHE_REDIS_URL to share it between workers.
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL')
+    CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '256'))
+    CACHE_DEFAULT_TTL = int(os.getenv('CACHE_DEFAULT_TTL', '300'))
+    # Requests slower than this are logged with their most expensive SQL statements (see metrics.py).
+    SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', '1000'))
+    # Connection pool for every engine (Flask app and Streamlit pages alike). Each process
+    # holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections; pre-ping drops connections
+    # the server closed, and recycling replaces them before proxies or firewalls drop idle ones.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': True,
+    }
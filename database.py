@@ -0,0 +1,130 @@
+"""
+Shared database access for the Streamlit pages.
+
+Streamlit re-executes a page script on every interaction, but imported
+modules are loaded once per process, so the engine and its connection
+pool here are built once and shared by every page, session and rerun.
+Pool settings come from Config (the DB_POOL_* environment variables), the
+same ones the Flask app uses.
+
+Connections are handed out through session_scope() and connect(), which
+time how long each checkout waits for the pool; pool_stats() reports those
+waits together with the pool's current and peak utilisation.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from config import Config
+
+engine = create_engine(Config.SQLALCHEMY_DATABASE_URI, **Config.SQLALCHEMY_ENGINE_OPTIONS)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+class PoolStats:
+    """Checkout wait times and peak utilisation of one engine's pool."""
+
+    def __init__(self, samples=1000):
+        self.checkouts = 0
+        self.connects = 0
+        self.timed_checkouts = 0
+        self.peak_checked_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._waits = deque(maxlen=samples)  # Most recent waits, for percentiles.
+        self._lock = threading.Lock()
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.timed_checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            self._waits.append(seconds)
+
+    def record_checkout(self, checked_out):
+        with self._lock:
+            self.checkouts += 1
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def wait_percentile(self, q):
+        with self._lock:
+            waits = sorted(self._waits)
+        if not waits:
+            return None
+        return waits[min(int(q * len(waits)), len(waits) - 1)]
+
+
+stats = PoolStats()
+
+
+@event.listens_for(engine, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    stats.record_connect()
+
+
+@event.listens_for(engine, 'checkout')
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    stats.record_checkout(engine.pool.checkedout())
+
+
+@contextmanager
+def connect():
+    """A pooled Connection, e.g. for pd.read_sql. Returned to the pool on exit."""
+    started = time.perf_counter()
+    connection = engine.connect()
+    stats.record_wait(time.perf_counter() - started)
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+@contextmanager
+def session_scope():
+    """
+    A Session that commits when the block succeeds, rolls back when it raises
+    (re-raising the error) and is always closed.
+    """
+    session = SessionLocal()
+    try:
+        started = time.perf_counter()
+        session.connection()  # Check the connection out now so the wait is timed.
+        stats.record_wait(time.perf_counter() - started)
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def pool_stats():
+    """Current pool state plus checkout and wait counters, in milliseconds where timed."""
+    pool = engine.pool
+    size = pool.size() if hasattr(pool, 'size') else None
+    capacity = size + Config.SQLALCHEMY_ENGINE_OPTIONS['max_overflow'] if size is not None else None
+    checked_out = pool.checkedout() if hasattr(pool, 'checkedout') else None
+    p50, p95 = stats.wait_percentile(0.5), stats.wait_percentile(0.95)
+    return {
+        'pool_size': size,
+        'max_overflow': Config.SQLALCHEMY_ENGINE_OPTIONS['max_overflow'],
+        'checked_out': checked_out,
+        'peak_checked_out': stats.peak_checked_out,
+        'utilisation': round(checked_out / capacity, 4) if capacity else None,
+        'peak_utilisation': round(stats.peak_checked_out / capacity, 4) if capacity else None,
+        'checkouts': stats.checkouts,
+        'connections_opened': stats.connects,
+        'wait_ms_avg': round(stats.total_wait / stats.timed_checkouts * 1000, 3) if stats.timed_checkouts else None,
+        'wait_ms_p50': round(p50 * 1000, 3) if p50 is not None else None,
+        'wait_ms_p95': round(p95 * 1000, 3) if p95 is not None else None,
+        'wait_ms_max': round(stats.max_wait * 1000, 3),
+    }
@@ -0,0 +1,163 @@
+"""
+Chunked export of DailyOperation rows for /api/v1/export.
+
+Rows are read through a server-side cursor in fixed-size chunks and each
+chunk is encoded as soon as it arrives, so memory stays flat regardless of
+how long the requested period is. Besides CSV, the rows can be encoded as
+Parquet or as an Arrow IPC stream, both typed from the DailyOperation model
+and compressed; those formats need pyarrow.
+"""
+import csv
+import io
+from itertools import chain
+
+from sqlalchemy import Boolean, Date, Integer, Numeric, String, Time, select
+
+from models import DailyOperation
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only the binary export formats need pyarrow.
+    pa = pq = None
+
+CHUNK_SIZE = 5000
+COMPRESSION = 'zstd'
+
+# format name -> mimetype, in order of preference when negotiating on Accept.
+FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+
+def negotiate_format(requested, accept_mimetypes):
+    """Picks the export format from an explicit `format` argument or, failing that, the Accept header."""
+    if requested:
+        return requested
+    best = accept_mimetypes.best_match(FORMATS.values(), default=FORMATS['csv'])
+    return next(name for name, mimetype in FORMATS.items() if mimetype == best)
+
+
+def operations_between(start_date, end_date):
+    """Statement selecting every DailyOperation column for a date range."""
+    return select(DailyOperation.__table__).where(
+        DailyOperation.operation_date.between(start_date, end_date)
+    ).order_by(DailyOperation.operation_date, DailyOperation.id)
+
+
+def iter_chunks(connection, statement, chunk_size=CHUNK_SIZE):
+    """
+    Executes `statement` on `connection` (a Session or Connection) with a
+    server-side cursor and yields lists of at most `chunk_size` rows.
+    """
+    result = connection.execute(statement.execution_options(yield_per=chunk_size))
+    for partition in result.partitions():
+        yield partition
+
+
+def peek(chunks):
+    """
+    Fetches the first chunk so callers can detect an empty result before
+    streaming. Returns None if there are no rows, otherwise an iterator over
+    all the chunks.
+    """
+    first = next(chunks, None)
+    if first is None:
+        return None
+    return chain([first], chunks)
+
+
+def csv_stream(columns, chunks):
+    """Yields a CSV document: the header line, then one encoded block per chunk."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def arrow_schema(table=DailyOperation.__table__):
+    """Arrow schema matching the column types of `table`."""
+    fields = []
+    for column in table.columns:
+        if isinstance(column.type, Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column.type, Integer):
+            arrow_type = pa.int64() if column.primary_key else pa.int32()
+        elif isinstance(column.type, Numeric):
+            arrow_type = pa.decimal128(column.type.precision, column.type.scale)
+        elif isinstance(column.type, Date):
+            arrow_type = pa.date32()
+        elif isinstance(column.type, Time):
+            arrow_type = pa.time64('us')
+        elif isinstance(column.type, String):
+            arrow_type = pa.string()
+        else:
+            raise TypeError(f"No Arrow type for column {column.name} ({column.type})")
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+def _record_batch(schema, rows):
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(values, type=field.type) for field, values in zip(schema, columns)], schema=schema
+    )
+
+
+class _DrainableSink(io.RawIOBase):
+    """
+    Write-only file whose buffered bytes can be drained while its position
+    keeps counting, so Parquet footers still get the right offsets.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def parquet_stream(chunks, schema=None):
+    """Yields a Parquet file with one row group per chunk."""
+    schema = schema or arrow_schema()
+    sink = _DrainableSink()
+    with pq.ParquetWriter(sink, schema, compression=COMPRESSION) as writer:
+        for rows in chunks:
+            writer.write_batch(_record_batch(schema, rows))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def arrow_stream(chunks, schema=None):
+    """Yields an Arrow IPC stream with one record batch per chunk."""
+    schema = schema or arrow_schema()
+    sink = _DrainableSink()
+    options = pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+    with pa.ipc.new_stream(sink, schema, options=options) as writer:
+        for rows in chunks:
+            writer.write_batch(_record_batch(schema, rows))
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,153 @@
+"""
+Idempotency-Key support for the write endpoints of the API.
+
+A client that may retry a write sends a unique Idempotency-Key header. The
+first request with a key reserves it and stores its response; any retry with
+the same key gets that response replayed instead of running the write again.
+Keys expire after IDEMPOTENCY_KEY_TTL_HOURS.
+
+The stored response is committed in the same transaction as the write
+itself: views under @idempotent call commit() and on_commit() below instead
+of committing directly, and with a key those leave the commit to the
+decorator. A reservation whose request died before committing therefore
+never has a write behind it, and a retry can safely take it over.
+"""
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, g, jsonify, make_response, request
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# A reservation older than this whose request never committed (e.g. the worker died) may be taken over.
+ABANDONED_AFTER = timedelta(minutes=5)
+
+
+def _fingerprint():
+    """Hash of the request, so a key reused for a different request can be refused."""
+    digest = hashlib.sha256(f"{request.method} {request.path}\n".encode())
+    if request.mimetype == 'multipart/form-data':
+        # Multipart boundaries change between retries, so hash the parts instead of the raw body.
+        for name, upload in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            digest.update(name.encode())
+            digest.update(upload.read())
+            upload.seek(0)
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f"{name}={value}".encode())
+    else:
+        digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _reserve(key, fingerprint, now):
+    """Claims `key` for this request. Returns True if we own it, False if it already exists."""
+    ttl = timedelta(hours=current_app.config['IDEMPOTENCY_KEY_TTL_HOURS'])
+    db.session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.key == key,
+        (IdempotencyKey.expires_at < now)
+        | (IdempotencyKey.status_code.is_(None) & (IdempotencyKey.created_at < now - ABANDONED_AFTER))
+    ))
+    result = db.session.execute(insert(IdempotencyKey).values(
+        key=key, endpoint=request.endpoint, request_hash=fingerprint, created_at=now, expires_at=now + ttl
+    ).on_conflict_do_nothing())
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def _release(key):
+    """Drops a reservation so the client can retry a request that failed."""
+    db.session.rollback()
+    db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+    db.session.commit()
+
+
+def commit(session=None):
+    """
+    Commits a write endpoint's work; with an Idempotency-Key it only flushes, and
+    the decorator commits the work together with the stored response.
+    """
+    session = session or db.session
+    if g.get('idempotency_key'):
+        session.flush()
+    else:
+        session.commit()
+
+
+def on_commit(callback):
+    """Calls `callback` once the work committed by commit() is durable: now, or after the decorator's commit."""
+    if g.get('idempotency_key'):
+        g.idempotency_callbacks.append(callback)
+    else:
+        callback()
+
+
+def _replay(key, fingerprint):
+    record = db.session.get(IdempotencyKey, key)
+    if record is None:
+        return jsonify({"error": "This Idempotency-Key was released. Please retry."}), 409
+    if record.request_hash != fingerprint or record.endpoint != request.endpoint:
+        return jsonify({"error": "This Idempotency-Key was already used for a different request."}), 422
+    if record.status_code is None:
+        return jsonify({"error": "A request with this Idempotency-Key is still being processed."}), 409
+    response = current_app.response_class(record.response_body, status=record.status_code, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Decorator making a JSON write endpoint safe to retry. Requests without an
+    Idempotency-Key header run as usual. Server errors (5xx) roll the write back
+    and release the key so the retry runs it again; any other response is stored
+    and committed along with the write, then replayed.
+    """
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters."}), 400
+
+        fingerprint = _fingerprint()
+        reserved_at = datetime.utcnow()
+        if not _reserve(key, fingerprint, reserved_at):
+            return _replay(key, fingerprint)
+
+        g.idempotency_key, g.idempotency_callbacks = key, []
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            _release(key)
+            raise
+        finally:
+            g.idempotency_key = None
+        if response.status_code >= 500:
+            _release(key)
+            return response
+
+        # Matches our own reservation only: if it was taken over as abandoned, a retry owns the key now.
+        stored = db.session.execute(update(IdempotencyKey).where(
+            IdempotencyKey.key == key, IdempotencyKey.created_at == reserved_at, IdempotencyKey.status_code.is_(None)
+        ).values(status_code=response.status_code, response_body=response.get_data(as_text=True)))
+        if stored.rowcount != 1:
+            db.session.rollback()
+            return jsonify({"error": "This request took too long and was superseded by a retry. Please retry."}), 409
+        db.session.commit()
+        for callback in g.idempotency_callbacks:
+            callback()
+        return response
+    return decorated_function
+
+
+def purge_expired(session=None, now=None):
+    """Deletes expired keys. Returns how many were removed."""
+    session = session or db.session
+    result = session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < (now or datetime.utcnow())))
+    session.commit()
+    return result.rowcount
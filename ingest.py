@@ -0,0 +1,264 @@
+"""
+Validation and batched insertion of DailyOperation rows for the bulk API.
+
+Payloads may be a JSON array, NDJSON (one object per line) or CSV. Every row
+is validated and converted in a single pass using converters derived from
+the DailyOperation columns; valid rows are inserted in batches with one
+transaction per batch, and invalid rows are reported back by position.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime, time
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import Boolean, Date, Integer, Numeric, String, Time, insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import DailyOperation, record_contract_entries, record_operation_changes
+
+BATCH_SIZE = 1000
+REQUIRED_FIELDS = ('truck_type', 'number_of_trucks', 'equipment_make', 'site_location', 'operation_date')
+
+JSON_TYPES = ('application/json',)
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+CSV_TYPES = ('text/csv', 'application/csv')
+
+_TRUE = {'true', 'yes', 'y', '1'}
+_FALSE = {'false', 'no', 'n', '0'}
+
+
+class PayloadError(ValueError):
+    """The request body could not be read as rows at all."""
+
+
+class PayloadTooLarge(PayloadError):
+    """The request body decompresses to more than the allowed size."""
+
+
+def decode_body(body, content_encoding, max_bytes):
+    """
+    Undoes a gzip Content-Encoding on a request body, stopping once the output
+    passes `max_bytes` so a small upload can't inflate without bound.
+    """
+    if not content_encoding or content_encoding == 'identity':
+        return body
+    if content_encoding not in ('gzip', 'x-gzip'):
+        raise PayloadError(f"Unsupported Content-Encoding '{content_encoding}'. Use gzip.")
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        decoded = inflater.decompress(body, max_bytes + 1)
+    except zlib.error:
+        raise PayloadError("Body is not valid gzip data.")
+    if len(decoded) > max_bytes:
+        raise PayloadTooLarge(f"Decompressed body is larger than {max_bytes} bytes.")
+    if not inflater.eof:
+        raise PayloadError("Body is truncated gzip data.")
+    return decoded
+
+
+def _to_int(value):
+    if isinstance(value, bool):
+        raise ValueError("expected an integer")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return int(str(value).strip())
+
+
+def _to_decimal(value):
+    if isinstance(value, bool):
+        raise ValueError("expected a number")
+    try:
+        return Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError("expected a number")
+
+
+def _to_date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value).strip(), '%Y-%m-%d').date()
+
+
+def _to_time(value):
+    if isinstance(value, time):
+        return value
+    value = str(value).strip()
+    return datetime.strptime(value, '%H:%M:%S' if value.count(':') == 2 else '%H:%M').time()
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in _TRUE:
+        return True
+    if text in _FALSE:
+        return False
+    raise ValueError("expected true/false or yes/no")
+
+
+def _string_converter(length):
+    def convert(value):
+        value = str(value)
+        if length and len(value) > length:
+            raise ValueError(f"longer than {length} characters")
+        return value
+    return convert
+
+
+def _converter(column):
+    if isinstance(column.type, Boolean):
+        return _to_bool
+    if isinstance(column.type, Integer):
+        return _to_int
+    if isinstance(column.type, Numeric):
+        return _to_decimal
+    if isinstance(column.type, Date):
+        return _to_date
+    if isinstance(column.type, Time):
+        return _to_time
+    if isinstance(column.type, String):
+        return _string_converter(column.type.length)
+    raise TypeError(f"No converter for column {column.name} ({column.type})")
+
+
+# column name -> converter for everything a client may send (the id is assigned by the database).
+CONVERTERS = {c.name: _converter(c) for c in DailyOperation.__table__.columns if not c.primary_key}
+
+
+def read_rows(body, content_type):
+    """
+    Splits a request body into raw row dicts according to its content type.
+    Malformed NDJSON lines come back as PayloadError instances so they can be
+    reported per row. Raises PayloadError if the body can't be read at all.
+    """
+    text = body.decode('utf-8-sig') if isinstance(body, bytes) else body
+    if content_type in NDJSON_TYPES:
+        return [_ndjson_row(line) for line in text.splitlines() if line.strip()]
+    if content_type in CSV_TYPES:
+        return list(csv.DictReader(io.StringIO(text)))
+    if content_type in JSON_TYPES:
+        try:
+            rows = json.loads(text)
+        except ValueError as e:
+            raise PayloadError(f"Invalid JSON payload: {e}")
+        if not isinstance(rows, list):
+            raise PayloadError("Expected a JSON array of operations.")
+        return rows
+    raise PayloadError("Unsupported content type. Send a JSON array, NDJSON or CSV.")
+
+
+def upload_content_type(filename, mimetype):
+    """Content type for a multipart upload, going by the file extension when the browser sends a generic one."""
+    extension = (filename or '').rsplit('.', 1)[-1].lower()
+    by_extension = {'csv': CSV_TYPES[0], 'json': JSON_TYPES[0], 'ndjson': NDJSON_TYPES[0], 'jsonl': NDJSON_TYPES[0]}
+    return by_extension.get(extension, mimetype)
+
+
+def _ndjson_row(line):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return PayloadError(f"Invalid JSON: {e}")
+
+
+def validate_row(raw):
+    """
+    Converts one raw row into column values. Returns (values, None) on
+    success or (None, errors) where errors maps field names to messages.
+    """
+    if isinstance(raw, PayloadError):
+        return None, {'_row': str(raw)}
+    if not isinstance(raw, dict):
+        return None, {'_row': "Expected an object."}
+
+    values, errors = {}, {}
+    for field, value in raw.items():
+        if field is None:
+            # csv.DictReader files the cells beyond the header under None.
+            errors['_row'] = "More values than header columns."
+            continue
+        converter = CONVERTERS.get(field)
+        if converter is None:
+            errors[field] = "Unknown field."
+            continue
+        if value is None or value == '':
+            values[field] = None
+            continue
+        try:
+            values[field] = converter(value)
+        except (TypeError, ValueError) as e:
+            errors[field] = f"Invalid value {value!r}: {e}"
+    for field in REQUIRED_FIELDS:
+        if values.get(field) is None and field not in errors:
+            errors[field] = "This field is required."
+    return (None, errors) if errors else (values, None)
+
+
+def validate_rows(raw_rows):
+    """Validates every row in one pass. Returns (valid, errors) as lists of (index, values) and (index, errors)."""
+    valid, invalid = [], []
+    for index, raw in enumerate(raw_rows):
+        values, errors = validate_row(raw)
+        if errors:
+            invalid.append((index, errors))
+        else:
+            valid.append((index, values))
+    return valid, invalid
+
+
+def _normalise(values):
+    """Gives every row the same keys so a batch can be sent as one executemany."""
+    row = dict.fromkeys(CONVERTERS)
+    row.update(values)
+    row['had_breakdown'] = bool(row['had_breakdown'])
+    row['had_rain'] = bool(row['had_rain'])
+    return row
+
+
+def _record(session, rows, created):
+    """Logs inserted rows to the change feed and the contract ledger. `created` holds their (id, date), in order."""
+    record_operation_changes(session, 'insert', created)
+    record_contract_entries(session, [dict(row, id=operation_id) for row, (operation_id, _) in zip(rows, created)])
+
+
+def insert_batches(session, valid, batch_size=BATCH_SIZE, commit=None):
+    """
+    Inserts the validated rows in batches, each under a savepoint and followed
+    by `commit` (session.commit by default; idempotency.commit defers it to the
+    request's end). If a batch fails, its rows are retried one by one under
+    savepoints so only the offending rows are rejected. Each batch logs its
+    rows to the change feed and adds them to the contract ledger in the same
+    transaction. Returns (inserted count, errors).
+    """
+    commit = commit or session.commit
+    statement = insert(DailyOperation.__table__).returning(
+        DailyOperation.id, DailyOperation.operation_date, sort_by_parameter_order=True
+    )
+    inserted, errors = 0, []
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        try:
+            with session.begin_nested():
+                rows = [_normalise(values) for _, values in batch]
+                _record(session, rows, session.execute(statement, rows).all())
+            commit()
+            inserted += len(batch)
+            continue
+        except SQLAlchemyError:
+            pass  # The savepoint has been rolled back; fall back to one row at a time.
+
+        for index, values in batch:
+            try:
+                with session.begin_nested():
+                    rows = [_normalise(values)]
+                    _record(session, rows, session.execute(statement, rows).all())
+                inserted += 1
+            except SQLAlchemyError as e:
+                errors.append((index, {'_row': str(getattr(e, 'orig', e)).strip()}))
+        commit()
+    return inserted, errors
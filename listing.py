@@ -0,0 +1,108 @@
+"""
+Keyset-paginated reads of DailyOperation rows for GET /api/v1/operations.
+
+Pages are ordered by (operation_date, id) and each one starts right after
+the last row of the previous page, which the cursor encodes. Every page is
+therefore a range scan of ix_daily_operation_date_id from that position,
+and costs the same however deep into the history it is, unlike OFFSET.
+"""
+import base64
+import binascii
+import json
+from datetime import date, time
+from decimal import Decimal
+
+from sqlalchemy import select, tuple_
+
+from models import DailyOperation
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+FIELDS = tuple(column.name for column in DailyOperation.__table__.columns)
+# Query parameter -> column, matched exactly.
+FILTERS = {
+    'site_location': DailyOperation.site_location,
+    'truck_type': DailyOperation.truck_type,
+    'facilitator_name': DailyOperation.facilitator_name,
+}
+ORDERS = ('asc', 'desc')
+
+
+def encode_cursor(operation_date, operation_id):
+    data = json.dumps([operation_date.isoformat(), operation_id]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(operation_date, id) from a cursor made by encode_cursor. Raises ValueError if it's malformed."""
+    try:
+        operation_date, operation_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return date.fromisoformat(operation_date), int(operation_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError("Invalid cursor.")
+
+
+def parse_fields(fields):
+    """
+    Column names to return for a comma-separated `fields` argument (every
+    column when empty). 'id' is always included. Raises ValueError for unknown names.
+    """
+    if not fields:
+        return FIELDS
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}.")
+    return ('id',) + tuple(dict.fromkeys(name for name in names if name != 'id'))
+
+
+def operations_page_query(fields=FIELDS, filters=None, start_date=None, end_date=None, after=None,
+                          order='asc', limit=PAGE_SIZE):
+    """
+    Up to `limit` rows with the columns in `fields`, after the (operation_date, id)
+    position `after` in `order`. The key columns are always selected, labelled
+    _date and _id, to build the next cursor.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Invalid order. Use one of: {', '.join(ORDERS)}.")
+    key = tuple_(DailyOperation.operation_date, DailyOperation.id)
+    columns = [DailyOperation.__table__.c[name] for name in fields]
+    query = select(*columns, DailyOperation.operation_date.label('_date'), DailyOperation.id.label('_id'))
+
+    for name, value in (filters or {}).items():
+        query = query.where(FILTERS[name] == value)
+    if start_date:
+        query = query.where(DailyOperation.operation_date >= start_date)
+    if end_date:
+        query = query.where(DailyOperation.operation_date <= end_date)
+    if after:
+        query = query.where(key > tuple_(*after) if order == 'asc' else key < tuple_(*after))
+
+    if order == 'asc':
+        query = query.order_by(DailyOperation.operation_date, DailyOperation.id)
+    else:
+        query = query.order_by(DailyOperation.operation_date.desc(), DailyOperation.id.desc())
+    return query.limit(limit)
+
+
+def _json_value(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def read_page(session, fields=FIELDS, filters=None, start_date=None, end_date=None, cursor=None,
+              order='asc', limit=PAGE_SIZE):
+    """
+    One page of operations as JSON-ready dicts. Returns (rows, next cursor,
+    whether there are more rows); the next cursor is None on the last page.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    result = session.execute(operations_page_query(fields, filters, start_date, end_date, after, order, limit + 1)).all()
+    has_more = len(result) > limit
+    result = result[:limit]
+    rows = [{name: _json_value(getattr(row, name)) for name in fields} for row in result]
+    next_cursor = encode_cursor(result[-1]._date, result[-1]._id) if has_more else None
+    return rows, next_cursor, has_more
@@ -1,10 +1,15 @@
 import os
 import io
+import argparse
 import functions_framework
-import pandas as pd
+import pyarrow.parquet as pq
 import requests
-from google.cloud import bigquery
-from datetime import date, timedelta
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+
+from api_client import APIClient, CONNECT_TIMEOUT
+from profiling import LoadStats, Profiler
+import warehouse
 
 # --- Environment Variables ---
 # These should be set in the Cloud Function configuration
@@ -13,6 +18,34 @@ API_KEY = os.environ.get('INTERNAL_API_KEY')
 GCP_PROJECT = os.environ.get('GCP_PROJECT')
 BIGQUERY_DATASET = os.environ.get('BIGQUERY_DATASET', 'truck_logistics_olap')
 BIGQUERY_TABLE = os.environ.get('BIGQUERY_TABLE', 'daily_operations_log')
+# Seconds to wait for the export to respond; large periods take a while to stream.
+API_READ_TIMEOUT = float(os.environ.get('API_READ_TIMEOUT', '300'))
+# Where loads go: 'bigquery', or 'parquet:<directory>' / 'sqlite:<path>' to run offline.
+WAREHOUSE_SINK = os.environ.get('WAREHOUSE_SINK', 'bigquery')
+# Backfill progress. Point this at durable storage so a restarted run can resume.
+BACKFILL_CHECKPOINT = os.environ.get('BACKFILL_CHECKPOINT', '/tmp/backfill_checkpoint.json')
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', str(warehouse.WORKERS)))
+# Set ETL_PROFILE=1 to profile run_daily_etl; reports go to ETL_PROFILE_DIR (see profiling.py).
+ETL_PROFILE = os.environ.get('ETL_PROFILE', '').lower() in ('1', 'true', 'yes')
+ETL_PROFILE_DIR = os.environ.get('ETL_PROFILE_DIR', '/tmp/etl_profiles')
+
+_api_client = None
+
+def get_api_client():
+    """
+    Client shared by every invocation served by this instance, so warm
+    invocations reuse its open connections to the API.
+    """
+    global _api_client
+    if _api_client is None:
+        _api_client = APIClient(FLASK_API_URL, API_KEY, timeout=(CONNECT_TIMEOUT, API_READ_TIMEOUT))
+    return _api_client
+
+def get_sink():
+    """The warehouse sink named by WAREHOUSE_SINK."""
+    return warehouse.sink_from_uri(
+        WAREHOUSE_SINK, project=GCP_PROJECT, table_id=f"{GCP_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+    )
 
 @functions_framework.http
 def run_daily_etl(request):
@@ -21,44 +54,91 @@ def run_daily_etl(request):
     and load it into a BigQuery table.
     """
     print("Starting daily ETL process...")
+    stats = LoadStats()
+    profiler = Profiler('daily-etl', stats, ETL_PROFILE_DIR) if ETL_PROFILE else None
+    with profiler or nullcontext():
+        result = _daily_etl(stats)
+    print(stats.report())
+    if profiler:
+        print(f"Profile written to {profiler.report_path}")
+    return result
 
+def _daily_etl(stats):
+    """Extracts yesterday's operations and loads them into the sink, timing each phase in `stats`."""
     # 1. --- EXTRACT ---
     # We extract data for 'yesterday' to ensure all operations for that day are complete.
     yesterday = date.today() - timedelta(days=1)
     start_date_str = yesterday.strftime('%Y-%m-%d')
 
-    headers = {'X-API-Key': API_KEY}
-    params = {'start_date': start_date_str, 'end_date': start_date_str}
-    
     try:
         print(f"Extracting data for date: {start_date_str}")
-        response = requests.get(f"{FLASK_API_URL}/api/v1/export", headers=headers, params=params)
-        response.raise_for_status()
+        with stats.phase('extract'):
+            content = get_api_client().export_bytes(yesterday, yesterday)
     except requests.exceptions.RequestException as e:
         print(f"Error extracting data from API: {e}")
         return f"API Extraction Failed: {e}", 500
 
-    if response.status_code == 404 or not response.text:
+    if not content:
+        # Clear the day too, in case an earlier run loaded rows that have since been removed.
+        with stats.phase('upload'):
+            get_sink().clear(yesterday, yesterday)
         print("No data found for the period. Exiting successfully.")
         return "No data for period.", 200
 
     # 2. --- TRANSFORM ---
-    # The data is already in a good CSV format. We load it into a DataFrame.
-    # BigQuery can infer schema, but for production, explicit schemas are better.
-    df = pd.read_csv(io.StringIO(response.text))
-    print(f"Successfully extracted {len(df)} rows.")
+    # The API sends a typed, compressed Parquet file, so there is nothing to parse or infer.
+    with stats.phase('transform'):
+        payload = io.BytesIO(content)
+        stats.rows['extracted'] = pq.read_metadata(payload).num_rows
+        payload.seek(0)
+    print(f"Successfully extracted {stats.rows['extracted']} rows.")
 
     # 3. --- LOAD ---
-    client = bigquery.Client(project=GCP_PROJECT)
-    table_id = f"{GCP_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+    # Replaces yesterday's partition, so rerunning the function never duplicates rows.
+    with stats.phase('upload'):
+        sink = get_sink()
+        stats.rows['loaded'] = sink.load(yesterday, yesterday, payload.getvalue())
+    print(f"Loaded {stats.rows['loaded']} rows into {sink}.")
 
-    job_config = bigquery.LoadJobConfig(
-        write_disposition="WRITE_APPEND",  # Append data to the table
-        autodetect=True, # For simplicity. In production, define a schema.
-    )
+    return "ETL process completed successfully.", 200
 
-    job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
-    job.result()  # Wait for the job to complete.
-    print(f"Loaded {job.output_rows} rows into {table_id}.")
+@functions_framework.http
+def run_backfill(request):
+    """
+    An HTTP-triggered Cloud Function that loads every day (or week) of a date
+    range, fetching several partitions at once. Query parameters: start_date
+    and end_date (YYYY-MM-DD, inclusive), optionally partition ('day' or
+    'week') and workers. Calling it again with the same arguments resumes
+    from the checkpoint.
+    """
+    try:
+        start_date = datetime.strptime(request.args['start_date'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d').date()
+        partition = request.args.get('partition', 'day')
+        workers = int(request.args.get('workers', BACKFILL_WORKERS))
+        if partition not in warehouse.PARTITIONS or workers < 1 or start_date > end_date:
+            raise ValueError
+    except (KeyError, ValueError):
+        return "Provide start_date <= end_date (YYYY-MM-DD), partition 'day' or 'week', and workers >= 1.", 400
+
+    try:
+        summary = warehouse.backfill(get_api_client(), get_sink(), start_date, end_date, partition,
+                                     workers=workers, checkpoint_path=BACKFILL_CHECKPOINT)
+    except requests.exceptions.RequestException as e:
+        print(f"Error extracting data from API: {e}")
+        return f"Backfill stopped, rerun to resume: {e}", 500
+    print(f"Backfill finished: {summary}")
+    return summary, 200
 
-    return "ETL process completed successfully.", 200
\ No newline at end of file
+if __name__ == '__main__':
+    # Run a backfill from the command line, e.g. against a local API and a Parquet sink:
+    #   WAREHOUSE_SINK=parquet:./warehouse python main.py 2024-01-01 2024-12-31 --partition week
+    parser = argparse.ArgumentParser(description="Backfill the warehouse from the export API.")
+    parser.add_argument('start_date', type=date.fromisoformat)
+    parser.add_argument('end_date', type=date.fromisoformat)
+    parser.add_argument('--partition', choices=warehouse.PARTITIONS, default='day')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--checkpoint', default='backfill_checkpoint.json')
+    args = parser.parse_args()
+    print(warehouse.backfill(get_api_client(), get_sink(), args.start_date, args.end_date, args.partition,
+                             workers=args.workers, checkpoint_path=args.checkpoint))
\ No newline at end of file
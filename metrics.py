@@ -0,0 +1,246 @@
+"""
+Request- and query-level metrics for the Flask app, served in the Prometheus
+text format by GET /metrics.
+
+init_app() times every request and records its response size. An engine
+event listener counts and times the SQL statements each request runs, so a
+page that suddenly issues hundreds of statements (an N+1 pattern) shows up
+in http_request_sql_statements before anyone notices it is slow. Requests
+slower than SLOW_REQUEST_MS are logged with the statements that took the
+most time.
+
+Streamed responses such as /api/v1/export are measured when their last
+byte has been sent, so their duration, size and SQL include the streaming.
+Metrics are kept per process; with several workers, Prometheus scrapes
+each one or the numbers are summed across them.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Statements listed in a slow-request log line.
+TOP_QUERIES = 5
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, as Prometheus expects."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0, 0])
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):  # Larger values only count towards +Inf, i.e. the total.
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(key, le=_number(bound))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(key, le='+Inf')} {values[-1]}"
+            yield f"{self.name}_sum{_labels(key)} {_number(values[-2])}"
+            yield f"{self.name}_count{_labels(key)} {values[-1]}"
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            series = dict(self._series)
+        for key, value in sorted(series.items()):
+            yield f"{self.name}{_labels(key)} {_number(value)}"
+
+
+class Collected:
+    """
+    Gauge or counter kept elsewhere (e.g. by the cache), read when scraped from
+    `collect`, which returns a number or a {labels tuple: number} dict.
+    """
+
+    def __init__(self, name, help, collect, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        values = self.collect()
+        if values is None:
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            if value is not None:
+                yield f"{self.name}{_labels(key)} {_number(value)}"
+
+
+class RequestStats:
+    """SQL run while serving one request, grouped by statement text."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_time = 0.0
+        self.by_statement = {}  # statement -> [count, seconds]
+        self.finished = False
+
+    def record(self, statement, seconds):
+        self.statements += 1
+        self.sql_time += seconds
+        entry = self.by_statement.setdefault(statement, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def top(self, n=TOP_QUERIES):
+        """The n statements that took the most time, as (statement, count, seconds)."""
+        ranked = sorted(self.by_statement.items(), key=lambda item: item[1][1], reverse=True)[:n]
+        return [(statement, count, seconds) for statement, (count, seconds) in ranked]
+
+
+class Metrics:
+    """The app's metric families, and the hooks that feed them."""
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Time to serve a request, including streaming the body.', DURATION_BUCKETS)
+        self.response_size = Histogram(
+            'http_response_size_bytes', 'Size of the response body.', SIZE_BUCKETS)
+        self.sql_statements = Histogram(
+            'http_request_sql_statements', 'SQL statements executed per request.', STATEMENT_BUCKETS)
+        self.sql_duration = Histogram(
+            'http_request_sql_duration_seconds', 'Time spent in SQL per request.', DURATION_BUCKETS)
+        self.slow_requests = Counter(
+            'http_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.')
+        self.families = [self.request_duration, self.response_size, self.sql_statements, self.sql_duration,
+                         self.slow_requests]
+        self.slow_request_seconds = None
+        self.logger = None
+
+    def add_collected(self, name, help, collect, kind='gauge'):
+        self.families.append(Collected(name, help, collect, kind))
+
+    def render(self):
+        """Every family in the Prometheus text exposition format."""
+        lines = []
+        for family in self.families:
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            lines.extend(family.samples())
+        return '\n'.join(lines) + '\n'
+
+    def init_app(self, app):
+        self.slow_request_seconds = app.config['SLOW_REQUEST_MS'] / 1000
+        self.logger = app.logger
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        # Registered on the Engine class so it covers every engine the app creates.
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def _before_request(self):
+        g.request_stats = RequestStats()
+
+    def _after_request(self, response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+        labels = {'method': request.method, 'route': request.url_rule.rule if request.url_rule else '<unmatched>'}
+        path = request.path
+        if response.is_streamed:
+            # Measured once the body has been sent; see _measure_stream.
+            response.response = self._measure_stream(response.response, stats, labels, path, response.status_code)
+        else:
+            self._finish(stats, labels, path, response.status_code, response.calculate_content_length() or 0)
+        return response
+
+    def _measure_stream(self, body, stats, labels, path, status_code):
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self._finish(stats, labels, path, status_code, size)
+
+    def _finish(self, stats, labels, path, status_code, size):
+        if stats.finished:
+            return
+        stats.finished = True
+        elapsed = time.perf_counter() - stats.started
+        self.request_duration.observe(elapsed, status=status_code, **labels)
+        self.response_size.observe(size, **labels)
+        self.sql_statements.observe(stats.statements, **labels)
+        self.sql_duration.observe(stats.sql_time, **labels)
+        if elapsed >= self.slow_request_seconds:
+            self.slow_requests.inc(**labels)
+            top = '; '.join(f"{count}x {seconds * 1000:.1f} ms: {_shorten(statement)}"
+                            for statement, count, seconds in stats.top())
+            self.logger.warning(
+                f"Slow request {labels['method']} {path} ({status_code}): {elapsed * 1000:.0f} ms, "
+                f"{stats.statements} SQL statements in {stats.sql_time * 1000:.0f} ms. Top queries: {top or 'none'}"
+            )
+
+
+def _shorten(statement, length=200):
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= length else statement[:length] + '...'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    # Only statements run while serving a request are attributed; CLI commands and other threads are ignored.
+    stats = g.get('request_stats') if has_app_context() else None
+    if stats is not None and not stats.finished and started is not None:
+        stats.record(statement, time.perf_counter() - started)
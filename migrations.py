@@ -0,0 +1,145 @@
+"""
+Versioned schema migrations.
+
+`db.create_all()` only creates missing tables; it never adds indexes or new
+structures to tables that already exist. Each migration here is a numbered
+step that is applied at most once and recorded in the schema_version table.
+`flask db-upgrade` applies whatever is pending, each step in its own
+transaction. Steps are written to be safe on a database that already has
+some of their objects (e.g. one created from the current models).
+
+To change the schema, update models.py and append a step to MIGRATIONS.
+"""
+from sqlalchemy import inspect, insert, literal, select, text
+
+from models import (db, DailyOperation, DimDate, DimEquipment, DimSite, DimFacilitator, FactOperations,
+                    EtlWatermark, IdempotencyKey, AggDailyOperations, OperationChange, ContractLedger, SchemaVersion,
+                    refresh_contracts)
+from olap import rebuild_rollups
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Registers the decorated function(connection) as schema migration `version`."""
+    def register(step):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "Migrations must be added in version order"
+        MIGRATIONS.append((version, description, step))
+        return step
+    return register
+
+
+def _create_tables(connection, *models):
+    for model in models:
+        model.__table__.create(connection, checkfirst=True)
+
+
+def _create_indexes(connection, *indexes):
+    existing = {}
+    inspector = inspect(connection)
+    for index in indexes:
+        table = index.table.name
+        if table not in existing:
+            existing[table] = {i['name'] for i in inspector.get_indexes(table)}
+        if index.name not in existing[table]:
+            index.create(connection)
+
+
+def _index(model, name):
+    return next(i for i in model.__table__.indexes if i.name == name)
+
+
+@migration(1, "Baseline schema")
+def _baseline(connection):
+    _create_tables(connection, DailyOperation, DimDate, DimEquipment, DimSite, DimFacilitator, FactOperations,
+                   EtlWatermark, IdempotencyKey)
+
+
+@migration(2, "Indexes for export, tracker and OLAP access paths")
+def _access_path_indexes(connection):
+    _create_indexes(
+        connection,
+        _index(DailyOperation, 'ix_daily_operation_date_id'),
+        _index(DailyOperation, 'ix_daily_operation_facilitator_date'),
+        _index(FactOperations, 'ix_fact_operations_source_operation_id'),
+        _index(FactOperations, 'ix_fact_operations_date_equipment'),
+    )
+
+
+@migration(3, "Daily rollup of facts per date, equipment and site")
+def _daily_rollup(connection):
+    _create_tables(connection, AggDailyOperations)
+    rebuild_rollups(connection)
+
+
+@migration(4, "Change feed for daily_operation")
+def _operation_change_log(connection):
+    _create_tables(connection, OperationChange)
+    # Seed the feed with the existing rows so a consumer starting from scratch sees them all.
+    if connection.execute(select(OperationChange.id).limit(1)).first() is None:
+        connection.execute(insert(OperationChange).from_select(
+            ['operation_id', 'action', 'operation_date'],
+            select(DailyOperation.id, literal('insert'), DailyOperation.operation_date).order_by(DailyOperation.id)
+        ))
+
+
+@migration(5, "Contract ledger per facilitator and lease")
+def _contract_ledger(connection):
+    _create_tables(connection, ContractLedger)
+    refresh_contracts(connection)
+
+
+@migration(6, "Oldest in-flight transaction on ETL watermarks")
+def _watermark_txid(connection):
+    connection.execute(text("ALTER TABLE etl_watermark ADD COLUMN IF NOT EXISTS last_txid BIGINT"))
+
+
+@migration(7, "Contract day counts computed at read time")
+def _contract_day_counts(connection):
+    connection.execute(text(
+        "ALTER TABLE contract_ledger DROP COLUMN IF EXISTS days_elapsed, DROP COLUMN IF EXISTS days_remaining"
+    ))
+
+
+@migration(8, "Contract balance renamed to the unpaid lease rate it holds")
+def _contract_unpaid_lease_rate(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('contract_ledger')}
+    if 'outstanding_balance' in columns:
+        connection.execute(text("ALTER TABLE contract_ledger RENAME COLUMN outstanding_balance TO unpaid_lease_rate"))
+
+
+def applied_versions(connection):
+    SchemaVersion.__table__.create(connection, checkfirst=True)
+    return set(connection.execute(select(SchemaVersion.version)).scalars())
+
+
+def pending(engine=None):
+    """Returns the (version, description) of every migration not yet applied."""
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+    return [(version, description) for version, description, _ in MIGRATIONS if version not in done]
+
+
+def upgrade(engine=None):
+    """Applies every pending migration in order. Returns the (version, description) pairs applied."""
+    engine = engine or db.engine
+    applied = []
+    for version, description, step in MIGRATIONS:
+        with engine.begin() as connection:
+            if version in applied_versions(connection):
+                continue
+            step(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(version=version, description=description))
+        applied.append((version, description))
+    return applied
+
+
+def stamp(engine=None):
+    """Marks every migration as applied, for a database just built from the current models."""
+    engine = engine or db.engine
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+        rows = [dict(version=v, description=d) for v, d, _ in MIGRATIONS if v not in done]
+        if rows:
+            connection.execute(SchemaVersion.__table__.insert(), rows)
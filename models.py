@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Integer, String, Date, Time, Numeric, Boolean, Text
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import (Column, Integer, BigInteger, String, Date, DateTime, Time, Numeric, Boolean, Text, Computed, and_,
+                        case, event, func, insert, inspect, or_, select, text, tuple_)
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg, insert as pg_insert
+from sqlalchemy.orm import Session, declarative_base
 from flask_sqlalchemy import SQLAlchemy # Keep for db object
 
 db = SQLAlchemy()
@@ -44,6 +46,13 @@ class DailyOperation(db.Model, Base):
     other_issues_no_rain = Column(Text, nullable=True)
     remarks = Column(Text, nullable=True)
 
+    __table_args__ = (
+        # Date-range reads (/api/v1/export), ordered by date then id.
+        db.Index('ix_daily_operation_date_id', 'operation_date', 'id'),
+        # One facilitator's entries, newest first (contract ledger refreshes).
+        db.Index('ix_daily_operation_facilitator_date', 'facilitator_name', operation_date.desc()),
+    )
+
 # --- OLAP / Data Warehouse Models ---
 # These tables are designed for fast analytical queries.
 # They would be populated from the DailyOperation table periodically.
@@ -97,4 +106,256 @@ class FactOperations(db.Model, Base):
     daily_commission = Column(Numeric(12, 2))
     
     # Link back to the original record for drill-through
-    source_operation_id = Column(Integer, db.ForeignKey('daily_operation.id'))
+    source_operation_id = Column(Integer, db.ForeignKey('daily_operation.id'), index=True)
+
+    # Date-range aggregates per equipment (the /tracker analytics join).
+    __table_args__ = (db.Index('ix_fact_operations_date_equipment', 'date_key', 'equipment_key'),)
+
+class AggDailyOperations(db.Model, Base):
+    """Daily rollup of FactOperations per date, equipment and site. Kept up to date by the OLAP loader."""
+    __tablename__ = 'agg_daily_operations'
+    date_key = Column(Integer, db.ForeignKey('dim_date.date_key'), primary_key=True)
+    equipment_key = Column(Integer, db.ForeignKey('dim_equipment.equipment_key'), primary_key=True)
+    site_key = Column(Integer, db.ForeignKey('dim_site.site_key'), primary_key=True)
+
+    # Measures, summed over the day's facts (null when no fact had a value)
+    fact_count = Column(Integer, nullable=False)
+    number_of_trucks = Column(Integer, nullable=False)
+    trips_covered = Column(Integer)
+    fuel_amount = Column(Numeric(14, 2))
+    hours_lost_breakdown = Column(Numeric(9, 2))
+    hours_lost_rain = Column(Numeric(9, 2))
+
+class EtlWatermark(db.Model, Base):
+    """High-water marks for incremental loaders, one row per loader."""
+    __tablename__ = 'etl_watermark'
+    name = Column(String(50), primary_key=True) # e.g., 'populate_olap'
+    last_id = Column(Integer, nullable=False, default=0) # Highest source id already processed
+    # Oldest transaction still running at the last load; rows it (or later ones) wrote below last_id are re-checked
+    last_txid = Column(BigInteger, nullable=True)
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
+
+class IdempotencyKey(db.Model, Base):
+    """Stored API responses, replayed when a client retries a write with the same Idempotency-Key."""
+    __tablename__ = 'idempotency_key'
+    key = Column(String(255), primary_key=True)
+    endpoint = Column(String(100), nullable=False)
+    request_hash = Column(String(64), nullable=False) # SHA-256 of the request, to catch reused keys
+    status_code = Column(Integer, nullable=True) # Null while the original request is still in flight
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class OperationChange(db.Model, Base):
+    """
+    Append-only log of every insert, update and delete on daily_operation, written in the
+    same transaction as the change itself (see record_operation_changes). Read in order
+    of (txid, id) through /api/v1/changes.
+    """
+    __tablename__ = 'operation_change'
+    id = Column(BigInteger, primary_key=True)
+    # Writing transaction; readers only take changes from transactions that have all finished.
+    txid = Column(BigInteger, nullable=False, server_default=text('txid_current()'))
+    operation_id = Column(Integer, nullable=False) # No foreign key: deletes are logged too
+    action = Column(String(10), nullable=False) # 'insert', 'update' or 'delete'
+    operation_date = Column(Date, nullable=False) # The row's date after the change (before, for deletes)
+    changed_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (db.Index('ix_operation_change_txid_id', 'txid', 'id'),)
+
+def record_operation_changes(connection, action, rows):
+    """Appends one OperationChange per (operation id, operation date) in `rows`."""
+    if rows:
+        connection.execute(insert(OperationChange.__table__), [
+            dict(operation_id=operation_id, action=action, operation_date=operation_date)
+            for operation_id, operation_date in rows
+        ])
+
+class ContractLedger(db.Model, Base):
+    """
+    One row per lease (facilitator and lease start date) summarising its daily operations,
+    kept up to date in the same transaction as the operations themselves (see
+    record_contract_entries and refresh_contracts). Lease terms come from the lease's
+    latest entry; the due date and unpaid lease rate are computed by Postgres. Day counts depend
+    on the current date, so the queries that read the ledger compute them (see queries.py).
+    """
+    __tablename__ = 'contract_ledger'
+    id = Column(Integer, primary_key=True)
+    facilitator_name = Column(String(100), nullable=False)
+    lease_start_date = Column(Date, nullable=True) # Null for entries that didn't give one
+
+    # Terms as of the latest entry, by operation date then id
+    latest_operation_id = Column(Integer, nullable=False)
+    lease_end_date = Column(Date, nullable=True)
+    expected_lease_days = Column(Integer, nullable=True)
+    total_lease_rate = Column(Numeric(12, 2), nullable=True)
+    daily_commission_rate = Column(Numeric(12, 2), nullable=True)
+    lease_payment_status = Column(String(50), nullable=True)
+    number_of_trucks = Column(Integer, nullable=False)
+
+    # Running totals over every entry
+    entries = Column(Integer, nullable=False)
+    accrued_commission = Column(Numeric(14, 2), nullable=False) # Daily commission rate x trucks, summed
+    first_operation_date = Column(Date, nullable=False)
+    last_operation_date = Column(Date, nullable=False)
+
+    # Derived, as of the latest entry
+    due_date = Column(Date, Computed(
+        "coalesce(lease_end_date, lease_start_date + expected_lease_days)", persisted=True
+    ))
+    # The lease rate while payment isn't complete; commission is tracked separately, in accrued_commission.
+    unpaid_lease_rate = Column(Numeric(12, 2), Computed(
+        "CASE WHEN lease_payment_status = 'Completed' THEN 0 ELSE coalesce(total_lease_rate, 0) END", persisted=True
+    ))
+    updated_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        # Entries without a lease start date share one row per facilitator.
+        db.UniqueConstraint('facilitator_name', 'lease_start_date', name='uq_contract_ledger_lease',
+                            postgresql_nulls_not_distinct=True),
+        # Overdue-lease reports: due_date < today.
+        db.Index('ix_contract_ledger_due_date', 'due_date'),
+    )
+
+# Columns of ContractLedger copied from the lease's latest entry.
+CONTRACT_TERMS = ('lease_end_date', 'expected_lease_days', 'total_lease_rate', 'daily_commission_rate',
+                  'lease_payment_status', 'number_of_trucks')
+
+def _commission(row):
+    return (row['daily_commission_rate'] or 0) * (row['number_of_trucks'] or 0)
+
+def record_contract_entries(connection, rows):
+    """
+    Adds newly inserted operations (dicts of DailyOperation columns, including id) to
+    their leases in ContractLedger. Rows without a facilitator belong to no lease.
+    """
+    leases = {}
+    for row in rows:
+        if not row.get('facilitator_name'):
+            continue
+        key = (row['facilitator_name'], row.get('lease_start_date'))
+        lease = leases.get(key)
+        if lease is None:
+            leases[key] = lease = dict(
+                facilitator_name=key[0], lease_start_date=key[1], entries=0, accrued_commission=0,
+                first_operation_date=row['operation_date'], last_operation_date=row['operation_date'],
+                latest_operation_id=row['id'], **{name: row.get(name) for name in CONTRACT_TERMS}
+            )
+        lease['entries'] += 1
+        lease['accrued_commission'] += _commission(row)
+        lease['first_operation_date'] = min(lease['first_operation_date'], row['operation_date'])
+        if (row['operation_date'], row['id']) > (lease['last_operation_date'], lease['latest_operation_id']):
+            lease.update(last_operation_date=row['operation_date'], latest_operation_id=row['id'],
+                         **{name: row.get(name) for name in CONTRACT_TERMS})
+    if not leases:
+        return
+
+    ledger = ContractLedger.__table__.c
+    statement = pg_insert(ContractLedger.__table__).values(list(leases.values()))
+    new = statement.excluded
+    newer = tuple_(new.last_operation_date, new.latest_operation_id) > \
+        tuple_(ledger.last_operation_date, ledger.latest_operation_id)
+    terms = {name: case((newer, new[name]), else_=ledger[name]) for name in CONTRACT_TERMS + ('latest_operation_id',)}
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=['facilitator_name', 'lease_start_date'],
+        set_=dict(
+            terms,
+            entries=ledger.entries + new.entries,
+            accrued_commission=ledger.accrued_commission + new.accrued_commission,
+            first_operation_date=func.least(ledger.first_operation_date, new.first_operation_date),
+            last_operation_date=func.greatest(ledger.last_operation_date, new.last_operation_date),
+            updated_at=func.now(),
+        )
+    ))
+
+def _lease_filter(columns, keys):
+    return or_(*(and_(columns.facilitator_name == facilitator, columns.lease_start_date.is_not_distinct_from(start))
+                 for facilitator, start in keys))
+
+def refresh_contracts(connection, keys=None):
+    """
+    Recomputes the ContractLedger rows of the given (facilitator, lease start date) keys,
+    or of every lease when keys is None, from daily_operation. Used where an entry is
+    updated or deleted, which can't be applied as a delta.
+    """
+    if keys is not None:
+        keys = {key for key in keys if key[0]}
+        if not keys:
+            return
+    operations, ledger = DailyOperation.__table__.c, ContractLedger.__table__
+    latest = lambda column: array_agg(aggregate_order_by(column, operations.operation_date.desc(), operations.id.desc()))[1]
+    query = select(
+        operations.facilitator_name, operations.lease_start_date, latest(operations.id),
+        *(latest(operations[name]) for name in CONTRACT_TERMS),
+        func.count(), func.coalesce(func.sum(operations.daily_commission_rate * operations.number_of_trucks), 0),
+        func.min(operations.operation_date), func.max(operations.operation_date),
+    ).where(operations.facilitator_name != '').group_by(operations.facilitator_name, operations.lease_start_date)
+
+    delete = ledger.delete()
+    if keys is not None:
+        delete = delete.where(_lease_filter(ledger.c, keys))
+        query = query.where(_lease_filter(operations, keys))
+    connection.execute(delete)
+    connection.execute(ledger.insert().from_select(
+        ['facilitator_name', 'lease_start_date', 'latest_operation_id', *CONTRACT_TERMS,
+         'entries', 'accrued_commission', 'first_operation_date', 'last_operation_date'],
+        query
+    ))
+
+def _operation_values(obj):
+    return {column.name: getattr(obj, column.name) for column in DailyOperation.__table__.columns}
+
+def _lease_keys(obj):
+    """The lease `obj` belongs to now and, if the flush changed it, the one it belonged to before."""
+    state = inspect(obj)
+    keys = {(obj.facilitator_name, obj.lease_start_date)}
+    facilitator, start = (state.attrs[name].history for name in ('facilitator_name', 'lease_start_date'))
+    if facilitator.deleted or start.deleted:
+        keys.add((facilitator.deleted[0] if facilitator.deleted else obj.facilitator_name,
+                  start.deleted[0] if start.deleted else obj.lease_start_date))
+    return keys
+
+def _operation_change(obj):
+    """(id, operation date, lease keys) of an updated or deleted operation."""
+    return obj.id, obj.operation_date, _lease_keys(obj)
+
+@event.listens_for(Session, 'before_flush')
+def _capture_operation_changes(session, flush_context, instances):
+    """
+    Reads what _log_operation_changes needs from DailyOperation objects the flush is
+    about to write. Updated and deleted rows are read now, while they can still be
+    loaded: after the flush an expired attribute of a deleted object raises
+    ObjectDeletedError. New objects only get their ids from the flush.
+    """
+    session.info['operation_changes'] = {
+        'insert': [obj for obj in session.new if isinstance(obj, DailyOperation)],
+        'update': [_operation_change(obj) for obj in session.dirty
+                   if isinstance(obj, DailyOperation) and session.is_modified(obj)],
+        'delete': [_operation_change(obj) for obj in session.deleted if isinstance(obj, DailyOperation)],
+    }
+
+@event.listens_for(Session, 'after_flush')
+def _log_operation_changes(session, flush_context):
+    """
+    Logs DailyOperation rows written through the ORM, and updates their leases in
+    ContractLedger, inside the flush's transaction.
+    """
+    changes = session.info.pop('operation_changes', None)
+    if changes is None:
+        return
+    inserted = [_operation_values(obj) for obj in changes['insert']]
+    record_operation_changes(session.connection(), 'insert', sorted((row['id'], row['operation_date']) for row in inserted))
+    record_contract_entries(session.connection(), inserted)
+    for action in ('update', 'delete'):
+        record_operation_changes(session.connection(), action, sorted(
+            (operation_id, operation_date) for operation_id, operation_date, _ in changes[action]
+        ))
+        if changes[action]:
+            refresh_contracts(session.connection(), set().union(*(keys for _, _, keys in changes[action])))
+
+class SchemaVersion(db.Model, Base):
+    """Schema migrations that have been applied to this database (see migrations.py)."""
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+    description = Column(String(200), nullable=False)
+    applied_at = Column(DateTime, nullable=False, server_default=func.now())
@@ -0,0 +1,352 @@
+"""
+Incremental loader for the OLAP star schema.
+
+New DailyOperation rows are found with a persisted high-water mark on
+daily_operation.id instead of checking every row against FactOperations.
+Dimension keys are resolved in memory through a DimensionCache, which only
+goes to the database for new members, and facts are inserted in batches, so
+a run costs a handful of statements per batch rather than several per row.
+DimDate is a pre-generated calendar (see seed_dim_date) whose key is derived
+from the date itself, so the loader never looks dates up. Each batch of new
+facts is also folded into the AggDailyOperations rollup.
+"""
+import pandas as pd
+from sqlalchemy import delete, event, exists, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import scoped_session
+
+from models import (db, DailyOperation, DimDate, DimEquipment, DimSite, DimFacilitator, FactOperations, EtlWatermark,
+                    AggDailyOperations, OperationChange)
+from profiling import LoadStats
+
+WATERMARK_NAME = 'populate_olap'
+BATCH_SIZE = 5000
+
+# Only the columns a fact needs, so extract batches stay narrow.
+OPERATION_COLUMNS = (
+    DailyOperation.id, DailyOperation.operation_date, DailyOperation.truck_type, DailyOperation.equipment_make,
+    DailyOperation.site_location, DailyOperation.facilitator_name, DailyOperation.number_of_trucks,
+    DailyOperation.trips_covered, DailyOperation.fuel_amount, DailyOperation.hours_lost,
+    DailyOperation.rain_hours_lost, DailyOperation.total_lease_rate, DailyOperation.daily_commission_rate,
+)
+
+
+def _get_watermark(session):
+    """Returns the loader's watermark row, locked for the rest of the transaction."""
+    mark = session.execute(
+        select(EtlWatermark).where(EtlWatermark.name == WATERMARK_NAME).with_for_update()
+    ).scalar_one_or_none()
+    if mark is None:
+        session.execute(insert(EtlWatermark).values(name=WATERMARK_NAME, last_id=0).on_conflict_do_nothing())
+        mark = session.execute(
+            select(EtlWatermark).where(EtlWatermark.name == WATERMARK_NAME).with_for_update()
+        ).scalar_one()
+    return mark
+
+
+def date_key(d):
+    """The DimDate surrogate key for a date, e.g. 20231225."""
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def build_calendar(start, end):
+    """Returns the DimDate rows for every day from `start` to `end` inclusive as a DataFrame."""
+    return _calendar_frame(pd.date_range(start, end, freq='D'))
+
+
+def _calendar_frame(days):
+    """DimDate rows for the days in a DatetimeIndex."""
+    return pd.DataFrame({
+        'date_key': days.year * 10000 + days.month * 100 + days.day,
+        'full_date': days.date,
+        'year': days.year,
+        'quarter': days.quarter,
+        'month': days.month,
+        'month_name': days.month_name(),
+        'day': days.day,
+        'day_of_week': days.day_name(),
+        'week_of_year': days.isocalendar().week.to_numpy(dtype='int64'),
+    })
+
+
+def seed_dim_date(session, start, end):
+    """
+    Inserts the calendar from `start` to `end` into DimDate in one bulk insert.
+    Days that already exist are left alone. Returns the number of days inserted.
+    Does not commit.
+    """
+    if start > end:
+        return 0
+    calendar = build_calendar(start, end)
+    result = session.execute(insert(DimDate.__table__).on_conflict_do_nothing(), calendar.to_dict('records'))
+    return result.rowcount
+
+
+def _ensure_days(session, days):
+    """
+    Makes sure DimDate has every one of `days`, inserting any that are missing
+    in one statement. Checking each day rather than the calendar's bounds means
+    a gap (a partial seed, a deleted day) can't break the facts' foreign key.
+    """
+    calendar = _calendar_frame(pd.DatetimeIndex(sorted(set(days))))
+    session.execute(insert(DimDate.__table__).on_conflict_do_nothing(), calendar.to_dict('records'))
+
+
+class DimensionCache:
+    """
+    In-memory natural-key -> surrogate-key maps for the OLAP dimensions.
+
+    Each dimension is preloaded with one SELECT; lookups after that are served
+    from memory and only the keys that are missing go to the database, inserted
+    as a single batch per dimension. An instance holds no session, so a
+    long-running (e.g. streaming) loader can keep one around across loads.
+    Keys added by a transaction that rolls back are dropped again, since the
+    members they point to no longer exist.
+    """
+
+    # name -> (model, natural key columns, surrogate key column)
+    DIMENSIONS = {
+        'equipment': (DimEquipment, ('truck_type', 'equipment_make'), 'equipment_key'),
+        'site': (DimSite, ('site_location',), 'site_key'),
+        'facilitator': (DimFacilitator, ('facilitator_name',), 'facilitator_key'),
+    }
+
+    def __init__(self):
+        self._keys = {}
+        self._uncommitted = []  # (dimension, natural key) added since the last commit
+        self.hits = dict.fromkeys(self.DIMENSIONS, 0)
+        self.misses = dict.fromkeys(self.DIMENSIONS, 0)
+
+    @staticmethod
+    def _natural(row, columns):
+        return row[0] if len(columns) == 1 else tuple(row)
+
+    def _select(self, name):
+        model, natural, surrogate = self.DIMENSIONS[name]
+        return select(getattr(model, surrogate), *(getattr(model, c) for c in natural))
+
+    def preload(self, session, names=None):
+        """Loads the full key map of each dimension that isn't cached yet."""
+        for name in names or self.DIMENSIONS:
+            if name in self._keys:
+                continue
+            natural = self.DIMENSIONS[name][1]
+            self._keys[name] = {self._natural(row[1:], natural): row[0] for row in session.execute(self._select(name))}
+
+    def resolve(self, session, name, keys):
+        """
+        Returns the surrogate key for each natural key in `keys`, in order.
+        `None` resolves to `None`. Unknown keys are inserted in one batch.
+        """
+        self.preload(session, [name])
+        cached = self._keys[name]
+        missing = {k for k in keys if k is not None and k not in cached}
+        if missing:
+            self._insert(session, name, missing)
+        self.misses[name] += len(missing)
+        self.hits[name] += sum(1 for k in keys if k is not None) - len(missing)
+        return [None if k is None else cached[k] for k in keys]
+
+    def _insert(self, session, name, missing):
+        model, natural, surrogate = self.DIMENSIONS[name]
+        rows = [self._member(name, k) for k in missing]
+        session.execute(insert(model).values(rows).on_conflict_do_nothing())
+        # Re-read rather than use RETURNING so members added by a concurrent loader are picked up too.
+        columns = [getattr(model, c) for c in natural]
+        if len(natural) == 1:
+            condition = columns[0].in_(list(missing))
+        else:
+            condition = tuple_(*columns).in_(list(missing))
+        for row in session.execute(self._select(name).where(condition)):
+            self._keys[name][self._natural(row[1:], natural)] = row[0]
+            self._uncommitted.append((name, self._natural(row[1:], natural)))
+        self._track(session)
+
+    def _track(self, session):
+        """Hooks the session's commit and rollback so uncommitted keys are kept or dropped with it."""
+        session = session.registry() if isinstance(session, scoped_session) else session
+        if not event.contains(session, 'after_commit', self._committed):
+            event.listen(session, 'after_commit', self._committed)
+            event.listen(session, 'after_rollback', self._rolled_back)
+
+    def _committed(self, session):
+        self._uncommitted.clear()
+
+    def _rolled_back(self, session):
+        for name, key in self._uncommitted:
+            self._keys.get(name, {}).pop(key, None)
+        self._uncommitted.clear()
+
+    @staticmethod
+    def _member(name, key):
+        """Builds the row for a new dimension member from its natural key."""
+        natural = DimensionCache.DIMENSIONS[name][1]
+        return dict(zip(natural, key if len(natural) > 1 else (key,)))
+
+    def invalidate(self, names=None):
+        """Drops cached maps, e.g. after dimensions were edited outside the loader."""
+        for name in names or list(self._keys):
+            self._keys.pop(name, None)
+
+    def stats(self):
+        """Per-dimension lookup counters; every hit is a query the loader didn't run."""
+        return {
+            name: {'hits': self.hits[name], 'misses': self.misses[name], 'cached': len(self._keys.get(name, ()))}
+            for name in self.DIMENSIONS
+        }
+
+
+def _fact_rows(session, cache, rows):
+    """Resolves the dimension keys for a batch of operations and returns FactOperations rows."""
+    date_keys = [date_key(r.operation_date) for r in rows]
+    equipment_keys = cache.resolve(session, 'equipment', [(r.truck_type, r.equipment_make) for r in rows])
+    site_keys = cache.resolve(session, 'site', [r.site_location for r in rows])
+    facilitator_keys = cache.resolve(session, 'facilitator', [r.facilitator_name or None for r in rows])
+    return [
+        dict(
+            date_key=date_key, equipment_key=equipment_key, site_key=site_key, facilitator_key=facilitator_key,
+            number_of_trucks=r.number_of_trucks, trips_covered=r.trips_covered, fuel_amount=r.fuel_amount,
+            hours_lost_breakdown=r.hours_lost, hours_lost_rain=r.rain_hours_lost,
+            total_lease_rate=r.total_lease_rate, daily_commission=r.daily_commission_rate,
+            source_operation_id=r.id
+        )
+        for r, date_key, equipment_key, site_key, facilitator_key
+        in zip(rows, date_keys, equipment_keys, site_keys, facilitator_keys)
+    ]
+
+
+ROLLUP_GRAIN = ('date_key', 'equipment_key', 'site_key')
+ROLLUP_MEASURES = ('number_of_trucks', 'trips_covered', 'fuel_amount', 'hours_lost_breakdown', 'hours_lost_rain')
+
+
+def _add(total, value):
+    """SUM semantics: nulls are skipped, and a sum of nothing but nulls stays null."""
+    if value is None:
+        return total
+    return value if total is None else total + value
+
+
+def update_rollups(session, facts):
+    """Adds a batch of new fact rows to AggDailyOperations with one upsert."""
+    totals = {}
+    for fact in facts:
+        key = tuple(fact[c] for c in ROLLUP_GRAIN)
+        row = totals.get(key)
+        if row is None:
+            row = totals[key] = dict(zip(ROLLUP_GRAIN, key), fact_count=0, **dict.fromkeys(ROLLUP_MEASURES))
+        row['fact_count'] += 1
+        for measure in ROLLUP_MEASURES:
+            row[measure] = _add(row[measure], fact[measure])
+    if not totals:
+        return
+
+    # Executemany rather than one giant VALUES clause: the statement compiles once (and is
+    # cached), and the driver still sends the rows in multi-row batches.
+    statement = insert(AggDailyOperations)
+    table, new = AggDailyOperations.__table__.c, statement.excluded
+    statement = statement.on_conflict_do_update(
+        index_elements=list(ROLLUP_GRAIN),
+        set_={
+            'fact_count': table.fact_count + new.fact_count,
+            # coalesce(a + b, a, b) keeps SUM's null handling when either side is null.
+            **{m: func.coalesce(table[m] + new[m], table[m], new[m]) for m in ROLLUP_MEASURES},
+        }
+    )
+    session.execute(statement, list(totals.values()))
+
+
+def rebuild_rollups(session):
+    """
+    Recomputes AggDailyOperations from the whole fact table. Works on a session or
+    connection; does not commit. Touches the loader's watermark, whose updated_at
+    keys the dashboard's caches of the rollup (see analytics.loaded_at).
+    """
+    session.execute(update(EtlWatermark).where(EtlWatermark.name == WATERMARK_NAME).values(updated_at=func.now()))
+    session.execute(delete(AggDailyOperations))
+    session.execute(insert(AggDailyOperations).from_select(
+        [*ROLLUP_GRAIN, 'fact_count', *ROLLUP_MEASURES],
+        select(
+            *(getattr(FactOperations, c) for c in ROLLUP_GRAIN),
+            func.count(),
+            *(func.sum(getattr(FactOperations, m)) for m in ROLLUP_MEASURES),
+        ).group_by(*(getattr(FactOperations, c) for c in ROLLUP_GRAIN))
+    ))
+
+
+def populate_olap(session=None, full=False, batch_size=BATCH_SIZE, cache=None, stats=None):
+    """
+    Loads every DailyOperation above the watermark into the star schema and
+    advances the watermark, all in one transaction. Pass `full=True` to rescan
+    from the first operation; already-loaded operations are still skipped.
+    Dimension keys are resolved through `cache` (a fresh DimensionCache if not
+    given) and facts are inserted `batch_size` rows at a time.
+    Returns the LoadStats for the run (`stats`, if given, e.g. to profile it).
+
+    Ids are allocated before commit, so a transaction still running when the
+    watermark is read may commit a row below it later. The watermark therefore
+    also records the oldest transaction in flight at that moment (as changes.py
+    does), and the next run re-checks every operation whose change-feed entry
+    comes from that transaction or a later one.
+    """
+    session = session or db.session
+    cache = cache or DimensionCache()
+    stats = stats or LoadStats()
+    stats.rows.update(operations=0, facts=0)
+
+    with stats.phase('extract'):
+        mark = _get_watermark(session)
+        last_id = 0 if full else mark.last_id
+        # Read from one snapshot: every transaction below settled_txid has finished, so any
+        # row committed after this point comes from settled_txid or later.
+        high_id, settled_txid = session.execute(select(
+            func.max(DailyOperation.id), func.txid_snapshot_xmin(func.txid_current_snapshot())
+        )).one()
+        high_id = high_id or 0
+    with stats.phase('preload'):
+        cache.preload(session)
+
+    def load(rows):
+        stats.rows['operations'] += len(rows)
+        with stats.phase('resolve'):
+            _ensure_days(session, [r.operation_date for r in rows])
+            facts = _fact_rows(session, cache, rows)
+        with stats.phase('facts'):
+            session.execute(insert(FactOperations.__table__), facts)
+            stats.rows['facts'] += len(facts)
+        with stats.phase('rollups'):
+            update_rollups(session, facts)
+
+    unloaded = ~exists().where(FactOperations.source_operation_id == DailyOperation.id)
+    if last_id and mark.last_txid is not None:
+        # Rows below the watermark from transactions that hadn't finished when it was set.
+        late = select(OperationChange.operation_id).where(
+            OperationChange.action == 'insert', OperationChange.txid >= mark.last_txid
+        )
+        with stats.phase('extract'):
+            rows = session.execute(select(*OPERATION_COLUMNS).where(
+                DailyOperation.id <= last_id, DailyOperation.id.in_(late), unloaded
+            ).order_by(DailyOperation.id)).all()
+        for start in range(0, len(rows), batch_size):
+            load(rows[start:start + batch_size])
+
+    query = select(*OPERATION_COLUMNS).order_by(DailyOperation.id).limit(batch_size)
+    if last_id == 0:
+        # Facts may already exist from before the watermark (or this is a --full run).
+        query = query.where(unloaded)
+
+    while last_id < high_id:
+        with stats.phase('extract'):
+            rows = session.execute(
+                query.where(DailyOperation.id > last_id, DailyOperation.id <= high_id)
+            ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        load(rows)
+
+    with stats.phase('commit'):
+        mark.last_id = max(mark.last_id, high_id)
+        mark.last_txid = settled_txid
+        session.commit()
+    stats.cache = cache.stats()
+    return stats
@@ -0,0 +1,131 @@
+"""
+Profiling mode for the batch jobs: `flask populate-olap --profile` and the
+daily ETL Cloud Function with ETL_PROFILE set.
+
+A Profiler wraps one run. It records a cProfile trace and counts the SQL
+statements each phase of the run's LoadStats issues. When the run ends it
+writes two files to the output directory:
+- <job>-<timestamp>.txt: phase timings with statement counts, then the
+  functions with the most cumulative and the most own time.
+- <job>-<timestamp>.prof: the raw trace, for pstats or a viewer such as snakeviz.
+
+Time inside the database or the network shows up under the driver's or the
+socket's functions, which separates it from ORM, pandas and Arrow work.
+
+LoadStats lives here rather than in olap so that callers which only time a
+run (the Cloud Function) need not import the loader and its dependencies.
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Functions listed in each section of the report.
+TOP_FUNCTIONS = 40
+
+
+class LoadStats:
+    """
+    Row counts and per-phase timings for a single loader run. While a
+    Profiler is attached, SQL statements are counted per phase too.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.rows = {}
+        self.cache = {}
+        self.statements = {}
+        self.current_phase = None
+        self._started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block and adds it to the named phase."""
+        start = time.perf_counter()
+        outer, self.current_phase = self.current_phase, name
+        try:
+            yield
+        finally:
+            self.current_phase = outer
+            self.phases[name] = self.phases.get(name, 0.0) + (time.perf_counter() - start)
+            self.elapsed = time.perf_counter() - self._started
+
+    def count_statement(self):
+        """Counts one SQL statement against the current phase ('other' outside any phase)."""
+        name = self.current_phase or 'other'
+        self.statements[name] = self.statements.get(name, 0) + 1
+
+    @property
+    def rows_per_sec(self):
+        facts = self.rows.get('facts', 0)
+        return facts / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        """Returns a human readable summary of the run."""
+        lines = [f"  {name:<12} {seconds * 1000:10.1f} ms" + (f" {self.statements.get(name, 0):8d} SQL" if self.statements else "")
+                 for name, seconds in self.phases.items()]
+        if self.statements.get('other'):
+            lines.append(f"  {'other':<12} {'':>13} {self.statements['other']:8d} SQL")
+        lines += [f"  {name:<12} {count:10d} rows" for name, count in self.rows.items()]
+        for name, counts in self.cache.items():
+            lines.append(f"  cache {name:<12} {counts['hits']:8d} hits {counts['misses']:6d} misses")
+        total = f"  {'total':<12} {self.elapsed * 1000:10.1f} ms"
+        lines.append(total + (f" ({self.rows_per_sec:,.0f} facts/sec)" if 'facts' in self.rows else ""))
+        return "\n".join(lines)
+
+
+class Profiler:
+    """Context manager that profiles one run of `job`, reporting against `stats` (a LoadStats)."""
+
+    def __init__(self, job, stats, directory='.', top=TOP_FUNCTIONS):
+        self.job = job
+        self.stats = stats
+        self.directory = directory
+        self.top = top
+        self.report_path = None
+        self._profile = cProfile.Profile()
+
+    def _count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.stats.count_statement()
+
+    def __enter__(self):
+        self.started_at = datetime.now()
+        event.listen(Engine, 'before_cursor_execute', self._count_statement)
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profile.disable()
+        event.remove(Engine, 'before_cursor_execute', self._count_statement)
+        self.write()
+
+    def write(self):
+        """Writes the report and the raw trace; returns the report's path."""
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{self.job}-{self.started_at:%Y%m%d-%H%M%S}")
+        self._profile.dump_stats(f"{base}.prof")
+
+        total = sum(self.stats.statements.values())
+        lines = [
+            f"Profile of {self.job}, started {self.started_at:%Y-%m-%d %H:%M:%S}",
+            f"{total} SQL statements in {self.stats.elapsed * 1000:.1f} ms",
+            "",
+            "Phases:",
+            self.stats.report(),
+        ]
+        for sort, title in (('cumulative', "cumulative time"), ('tottime', "own time")):
+            buffer = io.StringIO()
+            pstats.Stats(self._profile, stream=buffer).sort_stats(sort).print_stats(self.top)
+            lines += ["", f"Top {self.top} functions by {title}:", buffer.getvalue()]
+
+        self.report_path = f"{base}.txt"
+        with open(self.report_path, 'w') as f:
+            f.write("\n".join(lines))
+        return self.report_path
@@ -0,0 +1,122 @@
+"""
+Statements behind the app's main read paths, shared by the views and by
+`flask check-queries`, which EXPLAINs each of them and flags sequential
+scans on large tables.
+"""
+from datetime import date, timedelta
+
+from sqlalchemy import Date, func, literal, select, text
+from sqlalchemy.dialects.postgresql import distinct_on
+
+from models import ContractLedger, DailyOperation, DimEquipment, FactOperations, AggDailyOperations
+from analytics import aggregate_query
+from changes import changes_query
+from export import operations_between
+from listing import operations_page_query
+from olap import OPERATION_COLUMNS, date_key
+
+# Tables with fewer (estimated) rows than this are cheap to scan and aren't flagged.
+SEQ_SCAN_MIN_ROWS = 10000
+
+
+def _lease_days(today):
+    """Days since each lease started and until it is due, as of `today`."""
+    today = literal(today, Date)
+    return (
+        (today - func.coalesce(ContractLedger.lease_start_date, ContractLedger.first_operation_date)).label('days_elapsed'),
+        (ContractLedger.due_date - today).label('days_remaining'),
+    )
+
+
+def contracts(today):
+    """
+    Each facilitator's latest lease, as the DailyOperation row of its latest entry (the
+    tracker's row shape) plus the lease's due date, totals, unpaid rate and day counts.
+    """
+    latest = select(ContractLedger.latest_operation_id, ContractLedger.facilitator_name).add_columns(
+        ContractLedger.due_date, ContractLedger.entries, ContractLedger.accrued_commission,
+        ContractLedger.first_operation_date, ContractLedger.unpaid_lease_rate, *_lease_days(today)
+    ).ext(distinct_on(ContractLedger.facilitator_name))\
+     .order_by(ContractLedger.facilitator_name, ContractLedger.last_operation_date.desc(),
+               ContractLedger.latest_operation_id.desc())\
+     .subquery()
+    return select(DailyOperation.__table__, *list(latest.c)[2:])\
+        .join(latest, DailyOperation.id == latest.c.latest_operation_id)\
+        .order_by(latest.c.facilitator_name)
+
+
+def overdue_contracts(today):
+    """Leases past their due date whose lease rate is still unpaid, most overdue first."""
+    return select(ContractLedger.__table__, *_lease_days(today))\
+        .where(ContractLedger.due_date < today, ContractLedger.unpaid_lease_rate > 0)\
+        .order_by(ContractLedger.due_date)
+
+
+def equipment_summary(since):
+    """Total trips and fuel per equipment type from `since` onwards, read from the daily rollup."""
+    return select(
+        DimEquipment.truck_type,
+        DimEquipment.equipment_make,
+        func.sum(AggDailyOperations.trips_covered).label('total_trips'),
+        func.sum(AggDailyOperations.fuel_amount).label('total_fuel')
+    ).join(AggDailyOperations, DimEquipment.equipment_key == AggDailyOperations.equipment_key)\
+     .filter(AggDailyOperations.date_key >= date_key(since))\
+     .group_by(DimEquipment.truck_type, DimEquipment.equipment_make)\
+     .order_by(DimEquipment.truck_type, func.sum(AggDailyOperations.trips_covered).desc())
+
+
+def known_queries(today=None):
+    """Name -> representative statement for each access path worth checking."""
+    today = today or date.today()
+    return {
+        'export (quarter)': operations_between(today - timedelta(days=90), today),
+        'tracker contracts': contracts(today),
+        'overdue contracts': overdue_contracts(today),
+        'tracker equipment summary': equipment_summary(today - timedelta(days=90)),
+        'analytics aggregate (month by truck)': aggregate_query(today - timedelta(days=365), today, 'month', 'trips_covered'),
+        'analytics aggregate (month by facilitator)': aggregate_query(today - timedelta(days=365), today, 'month', 'trips_covered', 'facilitator_name'),
+        'populate-olap extract batch': select(*OPERATION_COLUMNS).where(DailyOperation.id > 0).order_by(DailyOperation.id).limit(5000),
+        'populate-olap fact probe': select(FactOperations.id).where(FactOperations.source_operation_id == 1),
+        'changes feed page': changes_query((0, 0)),
+        'operations page (site filter)': operations_page_query(
+            filters={'site_location': 'Site A'}, after=(today - timedelta(days=30), 0)
+        ),
+    }
+
+
+def explain(connection, statement):
+    """Returns the JSON plan Postgres would use for `statement`, without running it."""
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    return connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()[0]['Plan']
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _plan_nodes(child)
+
+
+def table_sizes(connection):
+    """Estimated row count of every table in the current schema."""
+    rows = connection.execute(text(
+        "SELECT relname, reltuples FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace"
+    ))
+    return {name: max(int(tuples), 0) for name, tuples in rows}
+
+
+def check_queries(connection, min_rows=SEQ_SCAN_MIN_ROWS, today=None):
+    """
+    EXPLAINs every known query. Returns a list of (name, plan, warnings), where
+    warnings name each sequential scan over a table of at least `min_rows`.
+    """
+    sizes = table_sizes(connection)
+    results = []
+    for name, statement in known_queries(today).items():
+        plan = explain(connection, statement)
+        warnings = [
+            f"Seq Scan on {node['Relation Name']} (~{sizes.get(node['Relation Name'], 0):,} rows)"
+            for node in _plan_nodes(plan)
+            if node['Node Type'] == 'Seq Scan' and sizes.get(node['Relation Name'], 0) >= min_rows
+        ]
+        results.append((name, plan, warnings))
+    return results
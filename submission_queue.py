@@ -0,0 +1,229 @@
+"""
+Durable outbox for operation entries made in the Streamlit entry app.
+
+The form writes each entry to a local SQLite file and returns at once. A
+background thread sends what is queued to /api/v1/operations/bulk in
+batches, so on a poor link one request carries every entry that piled up
+while it was down. An entry leaves the file only once the API has accepted
+or rejected it, so nothing is lost if the link or the app goes down.
+
+Before a batch is sent its entries are stamped with an idempotency key in
+the file. A batch that fails for a passing reason (no connection, a 5xx, a
+409 while the key is still in use, a 401 or 403 until the API key is fixed)
+is resent later, after an exponential backoff, with the same entries and
+key, so the API inserts it at most once even if the first attempt went
+through and only its response was lost.
+A batch refused for a reason a retry won't fix (any other 4xx, or a body
+that isn't the bulk endpoint's) has its entries marked rejected with the
+error, except on a 422 for a reused key, where they get a new key.
+"""
+import json
+import sqlite3
+import threading
+import uuid
+from contextlib import closing
+from datetime import datetime
+
+import requests
+
+BATCH_SIZE = 500
+# Delay before the first retry of a failed batch, doubled after each further failure.
+BACKOFF = 5
+MAX_BACKOFF = 300
+# Client errors worth retrying; every other 4xx is final. A rejected or missing API key
+# (401, 403) says nothing about the entries, so they wait for the key to be fixed.
+RETRY_STATUSES = (401, 403, 408, 409, 429)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submission (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    batch_key TEXT,
+    rejected_at TEXT,
+    errors TEXT
+)
+"""
+
+
+class SubmissionQueue:
+    """
+    Queue in the SQLite file at `path`, flushed through `client` (an
+    api_client.APIClient). Safe to share between threads; create one per process.
+    """
+
+    def __init__(self, path, client, batch_size=BATCH_SIZE, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.path = path
+        self.client = client
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_error = None
+        self.last_sent_at = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        with closing(self._connect()) as connection, connection:
+            # WAL lets the form append while the flusher reads and deletes.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def enqueue(self, payload):
+        """Stores one entry (a dict for the bulk endpoint) and wakes the flusher. Returns its queue id."""
+        with closing(self._connect()) as connection, connection:
+            cursor = connection.execute(
+                "INSERT INTO submission (payload, created_at) VALUES (?, ?)",
+                (json.dumps(payload, default=str), datetime.now().isoformat(timespec='seconds'))
+            )
+        self._wake.set()
+        return cursor.lastrowid
+
+    def _next_batch(self):
+        """
+        (key, [(id, payload)]) for the batch to send next, or None when nothing
+        is pending. A batch left unsent by an earlier attempt goes first, unchanged.
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT batch_key FROM submission WHERE batch_key IS NOT NULL AND rejected_at IS NULL LIMIT 1"
+            ).fetchone()
+            if row:
+                key = row[0]
+            else:
+                key = str(uuid.uuid4())
+                connection.execute(
+                    "UPDATE submission SET batch_key = ? WHERE id IN "
+                    "(SELECT id FROM submission WHERE batch_key IS NULL ORDER BY id LIMIT ?)",
+                    (key, self.batch_size)
+                )
+            entries = connection.execute(
+                "SELECT id, payload FROM submission WHERE batch_key = ? AND rejected_at IS NULL ORDER BY id", (key,)
+            ).fetchall()
+        return (key, entries) if entries else None
+
+    def _settle(self, entries, errors):
+        """Drops the accepted entries of a sent batch and keeps the rejected ones, with their errors, for review."""
+        rejected = {error['row']: error['errors'] for error in errors}
+        now = datetime.now().isoformat(timespec='seconds')
+        with closing(self._connect()) as connection, connection:
+            for index, (entry_id, _) in enumerate(entries):
+                if index in rejected:
+                    connection.execute(
+                        "UPDATE submission SET rejected_at = ?, errors = ? WHERE id = ?",
+                        (now, json.dumps(rejected[index]), entry_id)
+                    )
+                else:
+                    connection.execute("DELETE FROM submission WHERE id = ?", (entry_id,))
+
+    def _reject(self, entries, error):
+        """Marks every entry of a batch rejected with the same error."""
+        self._settle(entries, [{'row': index, 'errors': [error]} for index in range(len(entries))])
+
+    def _rekey(self, entries):
+        """Returns a batch's entries to the queue, so they are sent again under a new key."""
+        with closing(self._connect()) as connection, connection:
+            connection.executemany("UPDATE submission SET batch_key = NULL WHERE id = ?", [(i,) for i, _ in entries])
+
+    def flush(self):
+        """
+        Sends pending entries a batch at a time until none are left. Returns the
+        number of entries sent; raises requests.RequestException on the first
+        batch that can't be delivered yet.
+        """
+        sent = 0
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return sent
+            key, entries = batch
+            rows = [json.loads(payload) for _, payload in entries]
+            try:
+                result, status = self.client.create_operations_bulk(rows, idempotency_key=key)
+            except requests.HTTPError as e:
+                response = e.response
+                if response is None or response.status_code >= 500 or response.status_code in RETRY_STATUSES:
+                    raise
+                self._reject(entries, f"{response.status_code}: {_error_message(response)}")
+                continue
+            except ValueError as e:  # A response body that isn't JSON.
+                self._reject(entries, f"Unreadable response from the API: {e}")
+                continue
+
+            errors = result.get('errors') if isinstance(result, dict) else None
+            if status == 422 and errors is None and isinstance(result, dict) and 'error' in result:
+                # The key was used for a different request; this batch can't be sent under it.
+                self._rekey(entries)
+                continue
+            if not isinstance(errors, list):
+                self._reject(entries, f"Unexpected response from the API ({status}): {result!r:.200}")
+                continue
+            self._settle(entries, errors)
+            sent += len(entries)
+            self.last_sent_at = datetime.now()
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Cleared before flushing, so an entry queued mid-flush cuts the wait below short.
+            self._wake.clear()
+            try:
+                self.flush()
+                self.failures, self.last_error = 0, None
+                delay = None
+            except requests.RequestException as e:
+                # A batch that may yet go through: keep it and try again later.
+                self.failures += 1
+                self.last_error = str(e)
+                delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+            self._wake.wait(delay)
+
+    def start(self):
+        """Starts the background flusher, which sends entries as they are queued. Does nothing if it's running."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='submission-flusher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def retry_now(self):
+        """Skips the rest of the current backoff."""
+        self._wake.set()
+
+    def pending(self):
+        """Number of entries waiting to be sent."""
+        with closing(self._connect()) as connection:
+            return connection.execute("SELECT count(*) FROM submission WHERE rejected_at IS NULL").fetchone()[0]
+
+    def rejected(self):
+        """Entries the API refused, as dicts with their id, payload, errors and when they were rejected."""
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT id, payload, errors, rejected_at FROM submission WHERE rejected_at IS NOT NULL ORDER BY id"
+            ).fetchall()
+        return [{'id': entry_id, 'payload': json.loads(payload), 'errors': json.loads(errors), 'rejected_at': rejected_at}
+                for entry_id, payload, errors, rejected_at in rows]
+
+    def discard(self, entry_ids):
+        """Deletes rejected entries once they have been dealt with."""
+        with closing(self._connect()) as connection, connection:
+            connection.executemany(
+                "DELETE FROM submission WHERE id = ? AND rejected_at IS NOT NULL", [(i,) for i in entry_ids]
+            )
+
+
+def _error_message(response):
+    """The API's error message from a refused request, or the start of its body."""
+    try:
+        return response.json()['error']
+    except (ValueError, KeyError, TypeError):
+        return response.text[:200] or response.reason
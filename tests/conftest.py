@@ -0,0 +1,43 @@
+"""
+Shared fixtures. Tests that need Postgres run against TEST_DATABASE_URL,
+which they drop and rebuild for every test; never point it at real data.
+Without it those tests are skipped.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+if TEST_DATABASE_URL:
+    # Read by config.py when app is first imported.
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+
+
+@pytest.fixture
+def app():
+    """The Flask app inside an app context, over an empty, fully migrated database."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from app import app as flask_app
+    from models import db
+    import migrations
+
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        migrations.stamp()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def api_headers(app):
+    return {'X-API-Key': app.config['INTERNAL_API_KEY']}
@@ -0,0 +1,25 @@
+from datetime import date
+
+from analytics import daily_truck_totals, loaded_at
+from ingest import insert_batches
+from models import db, AggDailyOperations
+from olap import populate_olap, rebuild_rollups
+
+ROW = {'truck_type': 'truck', 'number_of_trucks': 2, 'equipment_make': 'Volvo', 'site_location': 'Lagos',
+       'operation_date': date(2024, 1, 1), 'trips_covered': 5}
+
+
+def test_rebuilding_the_rollups_moves_loaded_at(app):
+    insert_batches(db.session, [(0, dict(ROW))])
+    populate_olap(db.session)
+    loaded = loaded_at(db.session)
+    db.session.commit()
+
+    db.session.query(AggDailyOperations).delete()
+    db.session.commit()
+    assert daily_truck_totals(db.session).empty
+
+    rebuild_rollups(db.session)
+    db.session.commit()
+    assert loaded_at(db.session) > loaded
+    assert daily_truck_totals(db.session)['trips_covered'].tolist() == [5.0]
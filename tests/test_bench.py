@@ -0,0 +1,16 @@
+from sqlalchemy import func, select
+
+from bench import Bench
+from models import db, ContractLedger, DailyOperation, OperationChange
+
+
+def test_seed_fills_the_change_feed_and_the_ledger(app):
+    bench = Bench(app, size=200, requests=1)
+    bench.seed()
+
+    count = lambda model: db.session.execute(select(func.count()).select_from(model)).scalar()
+    assert count(DailyOperation) == 200
+    assert count(OperationChange) == 200
+    assert count(ContractLedger) > 0
+    assert db.session.execute(select(func.sum(ContractLedger.entries))).scalar() == \
+        db.session.execute(select(func.count()).where(DailyOperation.facilitator_name.is_not(None))).scalar()
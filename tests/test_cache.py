@@ -0,0 +1,42 @@
+from cache import Cache, LRUBackend, RedisBackend
+
+
+class FakeRedis:
+    """Just the commands RedisBackend uses; SCAN is deliberately missing."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+
+def redis_backend():
+    backend = RedisBackend.__new__(RedisBackend)
+    backend._client, backend._prefix = FakeRedis(), 'test:'
+    return backend
+
+
+def test_stats_count_lookups_without_scanning_redis():
+    cache = Cache(redis_backend())
+    assert cache.get_or_set('ns', 'k', lambda: 1) == 1
+    assert cache.get_or_set('ns', 'k', lambda: 2) == 1
+    cache.invalidate('ns')
+    assert cache.get_or_set('ns', 'k', lambda: 3) == 3
+
+    stats = cache.stats()
+    assert (stats['entries'], stats['hits'], stats['misses'], stats['invalidations']) == (None, 1, 2, 1)
+
+
+def test_stats_report_lru_entries():
+    cache = Cache(LRUBackend(max_entries=2))
+    for key in 'abc':
+        cache.get_or_set('ns', key, lambda: key)
+    assert cache.stats()['entries'] == 2
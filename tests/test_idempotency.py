@@ -0,0 +1,64 @@
+import sys
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, insert, select, update
+
+import idempotency
+from models import db, DailyOperation, IdempotencyKey
+
+ROW = {'truck_type': 'truck', 'number_of_trucks': 2, 'equipment_make': 'Volvo', 'site_location': 'Lagos',
+       'operation_date': '2024-01-01'}
+
+
+def _operations():
+    return db.session.execute(select(func.count()).select_from(DailyOperation)).scalar()
+
+
+@pytest.mark.parametrize('path, payload, rows', [
+    ('/api/v1/operations', ROW, 1),
+    ('/api/v1/operations/bulk', [ROW, ROW], 2),
+])
+def test_worker_dying_after_the_view_leaves_no_write(client, api_headers, monkeypatch, path, payload, rows):
+    headers = {**api_headers, 'Idempotency-Key': 'crash'}
+    make_response = idempotency.make_response
+
+    def dies(*args):
+        make_response(*args)
+        raise KeyboardInterrupt  # The worker is killed before the response is stored.
+
+    monkeypatch.setattr(idempotency, 'make_response', dies)
+    with pytest.raises(KeyboardInterrupt):
+        client.post(path, json=payload, headers=headers)
+    monkeypatch.undo()
+    db.session.rollback()
+    assert _operations() == 0
+
+    # Once the reservation counts as abandoned, a retry takes it over and writes exactly once.
+    db.session.execute(update(IdempotencyKey).values(created_at=IdempotencyKey.created_at - 2 * idempotency.ABANDONED_AFTER))
+    db.session.commit()
+    assert client.post(path, json=payload, headers=headers).status_code == 201
+    assert client.post(path, json=payload, headers=headers).headers['Idempotent-Replayed'] == 'true'
+    assert _operations() == rows
+
+
+def test_superseded_reservation_rolls_the_write_back(client, api_headers, monkeypatch):
+    app_module = sys.modules['app']
+    validate_rows = app_module.validate_rows
+
+    def taken_over(raw_rows):
+        # A retry takes the key over as abandoned while this request is still running.
+        with db.engine.begin() as connection:
+            connection.execute(IdempotencyKey.__table__.delete())
+            connection.execute(insert(IdempotencyKey).values(
+                key='slow', endpoint='create_operations_bulk', request_hash='retry',
+                created_at=datetime.utcnow(), expires_at=datetime.utcnow()
+            ))
+        return validate_rows(raw_rows)
+
+    monkeypatch.setattr(app_module, 'validate_rows', taken_over)
+    response = client.post('/api/v1/operations/bulk', json=[ROW], headers={**api_headers, 'Idempotency-Key': 'slow'})
+
+    assert response.status_code == 409
+    assert _operations() == 0
+    assert db.session.get(IdempotencyKey, 'slow').request_hash == 'retry'
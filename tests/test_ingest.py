@@ -0,0 +1,44 @@
+import io
+
+from sqlalchemy import func, select
+
+from ingest import read_rows, validate_row
+from models import db, DailyOperation
+
+HEADER = "truck_type,number_of_trucks,equipment_make,site_location,operation_date\n"
+
+
+def test_extra_csv_cells_are_a_row_error():
+    (raw,) = read_rows(HEADER + "truck,2,Volvo,Lagos,2024-01-01,EXTRA\n", 'text/csv')
+    values, errors = validate_row(raw)
+    assert values is None
+    assert errors == {'_row': "More values than header columns."}
+
+
+def test_bulk_csv_with_ragged_row_and_bad_value(client, api_headers):
+    body = HEADER + "truck,2,Volvo,Lagos,2024-01-01\ntruck,abc,Volvo,Lagos,2024-01-01,EXTRA\n"
+    response = client.post('/api/v1/operations/bulk', data=body, content_type='text/csv',
+                           headers={**api_headers, 'Idempotency-Key': 'ragged-csv'})
+
+    assert response.status_code == 207
+    (error,) = response.get_json()['errors']
+    assert error['row'] == 1
+    assert error['errors']['_row'] == "More values than header columns."
+    assert 'number_of_trucks' in error['errors']
+    assert db.session.execute(select(func.count()).select_from(DailyOperation)).scalar() == 1
+
+    # The stored response is replayed; the valid row isn't inserted twice.
+    retry = client.post('/api/v1/operations/bulk', data=body, content_type='text/csv',
+                        headers={**api_headers, 'Idempotency-Key': 'ragged-csv'})
+    assert retry.status_code == 207
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert db.session.execute(select(func.count()).select_from(DailyOperation)).scalar() == 1
+
+
+def test_bulk_upload_over_the_size_limit(app, client, api_headers, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    upload = (HEADER + "truck,2,Volvo,Lagos,2024-01-01\n" * 100).encode()
+    response = client.post('/api/v1/operations/bulk', headers=api_headers,
+                           data={'file': (io.BytesIO(upload), 'rows.csv')})
+    assert response.status_code == 413
+    assert 'error' in response.get_json()
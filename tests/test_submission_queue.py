@@ -0,0 +1,61 @@
+import pytest
+import requests
+
+from submission_queue import SubmissionQueue
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code, self.text, self.reason = status_code, str(body), 'Error'
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class FakeClient:
+    """Answers each create_operations_bulk call with the next scripted status and body."""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.keys = []
+
+    def create_operations_bulk(self, rows, idempotency_key=None):
+        self.keys.append(idempotency_key)
+        status, body = self.script.pop(0)
+        if status not in (201, 207, 422):
+            error = requests.HTTPError(f"{status} Client Error")
+            error.response = Response(status, body)
+            raise error
+        return body, status
+
+
+def _queue(tmp_path, client):
+    queue = SubmissionQueue(str(tmp_path / 'queue.db'), client)
+    queue.enqueue({'truck_type': 'truck'})
+    queue.enqueue({'truck_type': 'truck'})
+    return queue
+
+
+def test_unauthorized_keeps_entries_queued(tmp_path):
+    client = FakeClient((401, {'error': "Unauthorized. Invalid or missing API key."}), (201, {'errors': []}))
+    queue = _queue(tmp_path, client)
+
+    with pytest.raises(requests.HTTPError) as failure:
+        queue.flush()
+    assert failure.value.response.status_code == 401
+    assert queue.pending() == 2
+    assert queue.rejected() == []
+
+    # Once the key is fixed the same batch goes through, under the same idempotency key.
+    assert queue.flush() == 2
+    assert queue.pending() == 0
+    assert client.keys[0] == client.keys[1]
+
+
+def test_bad_request_rejects_the_batch(tmp_path):
+    queue = _queue(tmp_path, FakeClient((400, {'error': "Payload must be UTF-8 encoded."})))
+
+    assert queue.flush() == 0
+    assert queue.pending() == 0
+    assert [entry['errors'] for entry in queue.rejected()] == [["400: Payload must be UTF-8 encoded."]] * 2
@@ -5,6 +5,10 @@ from datetime import date
 import io
 import requests
 
+# Keep-alive, retrying client for the Flask API
+from api_client import APIClient
+from submission_queue import SubmissionQueue
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="Truck Logistics Dashboard",
@@ -15,22 +19,33 @@ st.set_page_config(
 # --- API Configuration ---
 FLASK_API_URL = st.secrets.get("FLASK_API_URL", "http://127.0.0.1:5000")
 API_KEY = st.secrets.get("INTERNAL_API_KEY")
+# Local file holding entries until the API has them
+SUBMISSION_QUEUE_PATH = st.secrets.get("SUBMISSION_QUEUE_PATH", "submission_queue.db")
 
 # --- Helper Functions ---
 
+@st.cache_resource
+def get_api_client():
+    """One client per process, so reruns reuse its pooled connections to the API."""
+    return APIClient(FLASK_API_URL, API_KEY)
+
+@st.cache_resource
+def get_submission_queue():
+    """One queue and background flusher per process."""
+    return SubmissionQueue(SUBMISSION_QUEUE_PATH, get_api_client()).start()
+
 def get_operations_data(period="monthly"):
     """Fetch operations data from the Flask API."""
     if not API_KEY:
         st.error("Internal API Key is not configured in secrets.")
         return pd.DataFrame()
 
-    headers = {'X-API-Key': API_KEY}
-    params = {'period': period}
     try:
-        response = requests.get(f"{FLASK_API_URL}/api/v1/export", headers=headers, params=params)
-        response.raise_for_status() # Raises an exception for 4XX/5XX errors
-        # Use io.StringIO to read the CSV response text into a DataFrame
-        return pd.read_csv(io.StringIO(response.text))
+        table = get_api_client().export_table(period=period)
+        if table is None: # No operations in the period
+            return pd.DataFrame()
+        # The API sends typed Parquet, so dates, times and amounts arrive with their types intact
+        return table.to_pandas()
     except requests.exceptions.RequestException as e:
         st.error(f"Failed to fetch data from API: {e}")
         return pd.DataFrame()
@@ -77,15 +92,28 @@ if submitted:
             # Add other fields from your DailyOperation model as needed
             "number_of_trucks": 1, # Example default
         }
-        headers = {'X-API-Key': API_KEY, 'Content-Type': 'application/json'}
-        try:
-            response = requests.post(f"{FLASK_API_URL}/api/v1/operations", headers=headers, json=payload)
-            response.raise_for_status()
-            st.success(f"✅ Operation logged successfully! (ID: {response.json().get('id')})")
-        except requests.exceptions.RequestException as e:
-            st.error(f"Failed to submit data to API: {e}")
-            if e.response:
-                st.error(f"API Response: {e.response.text}")
+        # Saved locally straight away; the background flusher sends it to the API when the link allows
+        get_submission_queue().enqueue(payload)
+        st.success("✅ Operation logged! It will be uploaded in the background.")
+
+# --- Upload Queue Status ---
+submission_queue = get_submission_queue()
+pending = submission_queue.pending()
+if pending:
+    st.info(f"📤 {pending} entries waiting to be uploaded.")
+    if submission_queue.last_error:
+        st.warning(f"Last upload attempt failed, retrying automatically: {submission_queue.last_error}")
+        if st.button("Retry Upload Now"):
+            submission_queue.retry_now()
+
+rejected = submission_queue.rejected()
+if rejected:
+    with st.expander(f"⚠️ {len(rejected)} entries rejected by the API"):
+        st.dataframe(pd.DataFrame([{**entry['payload'], 'errors': entry['errors'], 'rejected_at': entry['rejected_at']}
+                                   for entry in rejected]), use_container_width=True)
+        if st.button("Dismiss Rejected Entries"):
+            submission_queue.discard([entry['id'] for entry in rejected])
+            st.rerun()
 
 st.markdown("---")
 
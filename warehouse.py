@@ -0,0 +1,323 @@
+"""
+Partitioned loads of the operations export into a warehouse.
+
+A backfill splits a date range into day or week partitions, fetches them
+from /api/v1/export on a bounded pool of worker threads and loads them into
+a sink in date order as they arrive. Finished partitions are recorded in a
+checkpoint file, so a run that crashes picks up where it stopped when it is
+started again with the same arguments.
+
+Sinks take one partition's Parquet payload at a time, and every load
+replaces whatever the sink already held for those dates, so rerunning a
+partition never duplicates rows:
+- BigQuerySink: a day-partitioned BigQuery table with a schema derived from
+  DailyOperation; each day is overwritten through its partition decorator.
+- ParquetSink: one Parquet file per partition in a local directory.
+- SQLiteSink: rows in a local SQLite table, for querying results offline.
+"""
+import io
+import json
+import os
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import Boolean, Date, DateTime, Integer, Numeric, String, Time
+
+from models import DailyOperation
+
+try:
+    from google.cloud import bigquery
+except ImportError:  # Only needed by BigQuerySink.
+    bigquery = None
+
+PARTITIONS = ('day', 'week')
+WORKERS = 4
+# Column the BigQuery table is partitioned on, one partition per day.
+PARTITION_COLUMN = 'operation_date'
+
+
+def partitions(start_date, end_date, partition='day'):
+    """
+    Consecutive (start, end) date ranges covering start_date..end_date: single
+    days, or Monday-to-Sunday weeks clipped to the range.
+    """
+    if partition not in PARTITIONS:
+        raise ValueError(f"Invalid partition. Use one of: {', '.join(PARTITIONS)}.")
+    ranges, start = [], start_date
+    while start <= end_date:
+        end = start if partition == 'day' else start + timedelta(days=6 - start.weekday())
+        end = min(end, end_date)
+        ranges.append((start, end))
+        start = end + timedelta(days=1)
+    return ranges
+
+
+class Checkpoint:
+    """
+    JSON file naming the partitions of one backfill that are already loaded.
+    A checkpoint left by a run with different arguments is ignored.
+    """
+
+    def __init__(self, path, run):
+        self.path = path
+        self.run = run
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('run') == run:
+                self.done = set(state['done'])
+
+    def __contains__(self, partition):
+        return self.key(partition) in self.done
+
+    @staticmethod
+    def key(partition):
+        return f"{partition[0]}/{partition[1]}"
+
+    def mark(self, partition):
+        self.done.add(self.key(partition))
+        if not self.path:
+            return
+        # Write then rename, so a crash mid-write never leaves a corrupt checkpoint.
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump({'run': self.run, 'done': sorted(self.done)}, f)
+        os.replace(temporary, self.path)
+
+
+def bigquery_schema(table=DailyOperation.__table__):
+    """BigQuery schema matching the column types of `table`, as export.arrow_schema does for Arrow."""
+    fields = []
+    for column in table.columns:
+        options = {}
+        if isinstance(column.type, Boolean):
+            field_type = 'BOOL'
+        elif isinstance(column.type, Integer):
+            field_type = 'INT64'
+        elif isinstance(column.type, Numeric):
+            field_type = 'NUMERIC'
+            options = dict(precision=column.type.precision, scale=column.type.scale)
+        elif isinstance(column.type, Date):
+            field_type = 'DATE'
+        elif isinstance(column.type, DateTime):
+            field_type = 'DATETIME'
+        elif isinstance(column.type, Time):
+            field_type = 'TIME'
+        elif isinstance(column.type, String):
+            field_type = 'STRING'
+        else:
+            raise TypeError(f"No BigQuery type for column {column.name} ({column.type})")
+        mode = 'NULLABLE' if column.nullable else 'REQUIRED'
+        fields.append(bigquery.SchemaField(column.name, field_type, mode=mode, **options))
+    return fields
+
+
+def _split_days(table, start_date, end_date):
+    """Yields (day, rows of `table` on that day) for every day of start_date..end_date."""
+    day = start_date
+    while day <= end_date:
+        yield day, table.filter(pc.equal(table[PARTITION_COLUMN], pa.scalar(day, pa.date32())))
+        day += timedelta(days=1)
+
+
+class BigQuerySink:
+    """
+    Loads into a BigQuery table partitioned by day on operation_date. Each day
+    is loaded with WRITE_TRUNCATE into its partition (table$YYYYMMDD), which
+    swaps in the new rows atomically and leaves other days untouched. Days
+    with no rows have their partition deleted. The table is created with
+    the schema from bigquery_schema() on first use.
+    """
+
+    def __init__(self, table_id, project=None, client=None):
+        if bigquery is None:
+            raise RuntimeError("BigQuerySink needs google-cloud-bigquery installed.")
+        self.table_id = table_id
+        self.client = client or bigquery.Client(project=project)
+        self.schema = bigquery_schema()
+        self._table_ready = False
+
+    def _ensure_table(self):
+        if self._table_ready:
+            return
+        table = bigquery.Table(self.table_id, schema=self.schema)
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field=PARTITION_COLUMN
+        )
+        table = self.client.create_table(table, exists_ok=True)
+        partitioning = table.time_partitioning
+        if partitioning is None or partitioning.field != PARTITION_COLUMN or partitioning.type_ != 'DAY':
+            raise RuntimeError(
+                f"{self.table_id} exists but isn't partitioned by day on {PARTITION_COLUMN}. Copy it into a "
+                f"partitioned table (CREATE TABLE ... PARTITION BY {PARTITION_COLUMN} AS SELECT ...) first."
+            )
+        self._table_ready = True
+
+    def _partition(self, day):
+        return f"{self.table_id}${day:%Y%m%d}"
+
+    def load(self, start_date, end_date, payload):
+        self._ensure_table()
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=self.schema,  # Declared, not inferred, so types can't drift between loads
+            autodetect=False,
+            write_disposition="WRITE_TRUNCATE",  # Replace the partition the job targets
+        )
+        jobs = []
+        # Start a job per day, then wait for all of them; they run concurrently on BigQuery's side.
+        for day, rows in _split_days(pq.read_table(io.BytesIO(payload)), start_date, end_date):
+            if rows.num_rows == 0:
+                self.client.delete_table(self._partition(day), not_found_ok=True)
+                continue
+            buffer = io.BytesIO()
+            pq.write_table(rows, buffer, compression='zstd')
+            buffer.seek(0)
+            jobs.append(self.client.load_table_from_file(buffer, self._partition(day), job_config=job_config))
+        return sum(job.result().output_rows for job in jobs)
+
+    def clear(self, start_date, end_date):
+        day = start_date
+        while day <= end_date:
+            self.client.delete_table(self._partition(day), not_found_ok=True)
+            day += timedelta(days=1)
+
+    def __str__(self):
+        return f"BigQuery table {self.table_id}"
+
+
+class ParquetSink:
+    """Writes each partition to <directory>/operations_<start>_<end>.parquet, replacing any earlier file."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, start_date, end_date, payload):
+        path = os.path.join(self.directory, f"operations_{start_date}_{end_date}.parquet")
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(payload)
+        os.replace(f"{path}.tmp", path)
+        return pq.read_metadata(path).num_rows
+
+    def clear(self, start_date, end_date):
+        path = os.path.join(self.directory, f"operations_{start_date}_{end_date}.parquet")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def __str__(self):
+        return f"Parquet files in {self.directory}"
+
+
+class SQLiteSink:
+    """
+    Loads each partition into a SQLite table, replacing the rows already there
+    for its dates in the same transaction. Dates, times and amounts are stored
+    as text, so they compare and sort the way they would in the warehouse.
+    """
+
+    def __init__(self, path, table='daily_operations_log'):
+        self.path = path
+        self.table = table
+
+    @staticmethod
+    def _sqlite_table(table):
+        columns = []
+        for field, column in zip(table.schema, table.columns):
+            if pa.types.is_date(field.type) or pa.types.is_time(field.type) or pa.types.is_decimal(field.type):
+                column = column.cast(pa.string())
+            columns.append(column)
+        return pa.Table.from_arrays(columns, names=table.column_names)
+
+    def _delete(self, connection, start_date, end_date):
+        exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.table,)
+        ).fetchone()
+        if exists:
+            connection.execute(
+                f'DELETE FROM "{self.table}" WHERE operation_date BETWEEN ? AND ?',
+                (start_date.isoformat(), end_date.isoformat())
+            )
+
+    def load(self, start_date, end_date, payload):
+        frame = self._sqlite_table(pq.read_table(io.BytesIO(payload))).to_pandas()
+        with sqlite3.connect(self.path) as connection:
+            self._delete(connection, start_date, end_date)
+            frame.to_sql(self.table, connection, if_exists='append', index=False)
+        return len(frame)
+
+    def clear(self, start_date, end_date):
+        with sqlite3.connect(self.path) as connection:
+            self._delete(connection, start_date, end_date)
+
+    def __str__(self):
+        return f"SQLite table {self.table} in {self.path}"
+
+
+def sink_from_uri(uri, project=None, table_id=None):
+    """
+    Builds a sink from 'bigquery', 'parquet:<directory>' or 'sqlite:<path>'.
+    The BigQuery sink loads into `table_id`.
+    """
+    kind, _, location = uri.partition(':')
+    if kind == 'bigquery':
+        return BigQuerySink(table_id, project=project)
+    if kind == 'parquet' and location:
+        return ParquetSink(location)
+    if kind == 'sqlite' and location:
+        return SQLiteSink(location)
+    raise ValueError("Invalid sink. Use 'bigquery', 'parquet:<directory>' or 'sqlite:<path>'.")
+
+
+def backfill(client, sink, start_date, end_date, partition='day', workers=WORKERS, checkpoint_path=None, log=print):
+    """
+    Loads start_date..end_date into `sink` one partition at a time, fetching up
+    to `workers` partitions concurrently with `client` (an api_client.APIClient).
+    Partitions already in the checkpoint are skipped. Returns a summary dict.
+
+    Fetched payloads are loaded in date order on the calling thread, and no more
+    than 2 * `workers` are in flight at once, so memory stays bounded however
+    long the range is. A failed fetch or load stops the run; the partitions
+    loaded before it stay checkpointed.
+    """
+    checkpoint = Checkpoint(checkpoint_path, {'start': str(start_date), 'end': str(end_date), 'partition': partition})
+    todo = [p for p in partitions(start_date, end_date, partition) if p not in checkpoint]
+    summary = {'partitions': len(todo) + len(checkpoint.done), 'skipped': len(checkpoint.done), 'loaded': 0, 'empty': 0, 'rows': 0}
+    log(f"Backfilling {start_date}..{end_date} by {partition} into {sink}: "
+        f"{len(todo)} partitions to load, {summary['skipped']} already done.")
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for p in todo:
+                pending.append((p, executor.submit(client.export_bytes, *p)))
+                if len(pending) >= 2 * workers:
+                    _load_next(pending, sink, checkpoint, summary, log)
+            while pending:
+                _load_next(pending, sink, checkpoint, summary, log)
+        except BaseException:
+            for _, future in pending:
+                future.cancel()
+            raise
+    return summary
+
+
+def _load_next(pending, sink, checkpoint, summary, log):
+    (start, end), future = pending.popleft()
+    payload = future.result()
+    if payload:
+        rows = sink.load(start, end, payload)
+        summary['loaded'] += 1
+        summary['rows'] += rows
+        log(f"Loaded {rows} rows for {start}..{end}.")
+    else:
+        # Nothing upstream any more: drop what an earlier run loaded for these dates.
+        sink.clear(start, end)
+        summary['empty'] += 1
+    checkpoint.mark((start, end))